@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+from metrics import requests_shed_total
+
+# Lower runs first when requests wait for the same model
+PRIORITY_CHAT = 0
+PRIORITY_VISION = 1
+PRIORITY_IMAGE = 2
+PRIORITY_BACKGROUND = 3
+
+
+class Shed(Exception):
+    """Raised when a request waited longer than the admission deadline"""
+
+
+class _Waiter:
+    __slots__ = ("model", "rank", "future")
+
+    def __init__(self, model, rank, future):
+        self.model = model
+        self.rank = rank
+        self.future = future
+
+
+class Admission:
+    """Bounds the model requests in flight, per model and in total.
+
+    Requests over a limit wait in priority order (then arrival order). A
+    request that is still waiting after deadline seconds is shed with Shed.
+    Models without an entry in limits are only bound by total_limit.
+    """
+
+    def __init__(self, limits, total_limit=None, deadline=None):
+        self.limits = dict(limits)
+        self.total_limit = total_limit
+        self.deadline = deadline
+        self.active = {}    # model -> requests in flight
+        self.total = 0
+        self._waiters = []  # sorted by rank
+        self._seq = itertools.count()
+
+    def _has_room(self, model):
+        limit = self.limits.get(model)
+        if limit is not None and self.active.get(model, 0) >= limit:
+            return False
+        return self.total_limit is None or self.total < self.total_limit
+
+    def _grant(self, model):
+        self.active[model] = self.active.get(model, 0) + 1
+        self.total += 1
+
+    def position(self, waiter):
+        """1-based place of waiter among the requests waiting for the same model"""
+        position = 0
+        for other in self._waiters:
+            if other.model == waiter.model:
+                position += 1
+            if other is waiter:
+                return position
+        return 0
+
+    def queued(self, model=None):
+        return sum(1 for waiter in self._waiters if model is None or waiter.model == model)
+
+    async def acquire(self, model, priority, on_position=None, interval=2.0):
+        """Wait for room to call model.
+
+        While waiting, on_position(position) is awaited whenever the request's
+        place in the queue changes (checked every interval seconds).
+        """
+        # Waiters left after a dispatch have no room, so room for model means nobody is ahead
+        if self._has_room(model):
+            self._grant(model)
+            return
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(model, (priority, next(self._seq)), loop.create_future())
+        index = 0
+        while index < len(self._waiters) and self._waiters[index].rank < waiter.rank:
+            index += 1
+        self._waiters.insert(index, waiter)
+        deadline = None if self.deadline is None else loop.time() + self.deadline
+        shown = None
+        try:
+            while not waiter.future.done():
+                position = self.position(waiter)
+                if on_position is not None and position != shown:
+                    shown = position
+                    try:
+                        await on_position(position)
+                    except Exception as e:
+                        print(f"Error reporting queue position: {e}")
+                    if waiter.future.done():
+                        break
+                timeout = interval
+                if deadline is not None:
+                    timeout = min(timeout, deadline - loop.time())
+                    if timeout <= 0:
+                        requests_shed_total.inc(model)
+                        raise Shed(f"waited more than {self.deadline}s for {model}")
+                await asyncio.wait([waiter.future], timeout=timeout)
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._dispatch()
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as we gave up: hand the room to the next request
+                self.release(model)
+            raise
+
+    def release(self, model):
+        self.active[model] -= 1
+        self.total -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        for waiter in list(self._waiters):
+            if self.total_limit is not None and self.total >= self.total_limit:
+                break
+            if self._has_room(waiter.model):
+                self._waiters.remove(waiter)
+                self._grant(waiter.model)
+                waiter.future.set_result(None)
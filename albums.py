@@ -0,0 +1,44 @@
+import asyncio
+import time
+from config import conf
+
+
+class _Album:
+    __slots__ = ("messages", "last_seen")
+
+    def __init__(self, message):
+        self.messages = [message]
+        self.last_seen = time.monotonic()
+
+
+class AlbumCollector:
+    """Gathers the messages of a Telegram album (one message per photo).
+
+    The first part of an album waits until no new part has arrived for
+    window seconds and then gets every part; later parts get None.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._albums = {}  # media_group_id -> _Album
+
+    async def collect(self, message):
+        """All messages of message's album in order, or None if another part is collecting them"""
+        album = self._albums.get(message.media_group_id)
+        if album is not None:
+            album.messages.append(message)
+            album.last_seen = time.monotonic()
+            return None
+        album = self._albums[message.media_group_id] = _Album(message)
+        try:
+            while True:
+                remaining = album.last_seen + self.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+        finally:
+            del self._albums[message.media_group_id]
+        return sorted(album.messages, key=lambda part: part.message_id)
+
+
+album_collector = AlbumCollector(conf["album_window"])
@@ -0,0 +1,161 @@
+"""Local stand-ins for the Gemini client and AsyncTeleBot, for offline benchmarks.
+
+FakeClient mimics the parts of google.genai.Client the bot uses (streaming
+and non-streaming generate_content, context caches) and answers
+from a canned text with configurable chunking, delays and injected 429s.
+FakeBot records every Telegram API call with a timestamp instead of sending it.
+"""
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+from google.genai import types
+
+ANSWER = (
+    "Here is **an answer** with `inline code`, a [link](https://example.com) and "
+    "some punctuation (like this). It keeps going for a while.\n\n"
+    "```python\ndef f(x):\n    return x * 2\n```\n\n"
+    "- first item\n- second item\n\n"
+)
+
+
+class FakeSettings:
+    """Behaviour shared by every FakeClient; change it before the run starts"""
+
+    def __init__(self):
+        self.answer_chars = 2000
+        self.chunk_chars = 60
+        self.chunk_delay = 0.02
+        self.first_chunk_delay = 0.3
+        self.rate_limit_every = 0     # every Nth request answers 429; 0 never
+        self.requests = 0
+        self.rate_limited = 0
+        self.first_chunks = {}        # text of the last user message -> monotonic time its first chunk was sent
+
+
+settings = FakeSettings()
+
+
+class QuotaError(Exception):
+    """Looks like the 429 google-genai raises when a key is out of quota"""
+    status_code = 429
+
+    def __init__(self):
+        super().__init__("429 RESOURCE_EXHAUSTED. You exceeded your current quota")
+
+
+def _answer_text():
+    text = ANSWER * (settings.answer_chars // len(ANSWER) + 1)
+    return text[:settings.answer_chars]
+
+
+def _usage(prompt, answer):
+    return SimpleNamespace(prompt_token_count=len(str(prompt)) // 4 + 1, candidates_token_count=len(answer) // 4 + 1)
+
+
+def _check_quota():
+    settings.requests += 1
+    if settings.rate_limit_every and settings.requests % settings.rate_limit_every == 0:
+        settings.rate_limited += 1
+        raise QuotaError()
+
+
+def _last_text(contents):
+    if isinstance(contents, str):
+        return contents
+    parts = contents[-1].parts if contents and hasattr(contents[-1], "parts") else []
+    return next((part.text for part in parts if part.text), None)
+
+
+async def _stream(prompt):
+    answer = _answer_text()
+    await asyncio.sleep(settings.first_chunk_delay)
+    settings.first_chunks.setdefault(_last_text(prompt), time.monotonic())
+    chunks = [answer[i:i + settings.chunk_chars] for i in range(0, len(answer), settings.chunk_chars)]
+    for index, text in enumerate(chunks):
+        if index:
+            await asyncio.sleep(settings.chunk_delay)
+        last = index == len(chunks) - 1
+        content = types.Content(role="model", parts=[types.Part.from_text(text=text)])
+        yield SimpleNamespace(text=text, candidates=[SimpleNamespace(content=content)], usage_metadata=_usage(prompt, answer) if last else None)
+
+
+class _FakeModels:
+    async def generate_content(self, model, contents, config=None):
+        _check_quota()
+        await asyncio.sleep(settings.first_chunk_delay)
+        answer = _answer_text()
+        part = SimpleNamespace(text=answer, inline_data=None)
+        return SimpleNamespace(
+            text=answer,
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))],
+            usage_metadata=_usage(contents, answer),
+        )
+
+    async def generate_content_stream(self, model, contents, config=None):
+        _check_quota()
+        return _stream(contents)
+
+
+class _FakeCaches:
+    def __init__(self):
+        self.names = set()
+        self._ids = itertools.count(1)
+
+    async def create(self, model, config=None):
+        name = f"cachedContents/fake-{next(self._ids)}"
+        self.names.add(name)
+        return SimpleNamespace(name=name, model=model)
+
+    async def update(self, name, config=None):
+        return SimpleNamespace(name=name)
+
+    async def delete(self, name, config=None):
+        self.names.discard(name)
+
+
+class FakeClient:
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+        self.aio = SimpleNamespace(models=_FakeModels(), caches=_FakeCaches())
+
+
+class FakeBot:
+    """Records Telegram API calls as (monotonic time, method, chat_id, message_id, text)"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+
+    async def _call(self, method, chat_id, message_id=None, text=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append((time.monotonic(), method, chat_id, message_id, text))
+
+    def _message(self, chat_id):
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=next(self._message_ids))
+
+    async def reply_to(self, message, text, **kwargs):
+        sent = self._message(message.chat.id)
+        await self._call("reply_to", message.chat.id, sent.message_id, text)
+        return sent
+
+    async def send_message(self, chat_id, text, **kwargs):
+        sent = self._message(chat_id)
+        await self._call("send_message", chat_id, sent.message_id, text)
+        return sent
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        sent = self._message(chat_id)
+        await self._call("send_photo", chat_id, sent.message_id)
+        return sent
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        await self._call("edit_message_text", chat_id, message_id, text)
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call("delete_message", chat_id, message_id)
+        return True
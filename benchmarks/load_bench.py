@@ -0,0 +1,166 @@
+"""Offline load test of the bot's hot path.
+
+Drives simulated users through the real private-chat handler with a fake
+Gemini client and a fake AsyncTeleBot (see benchmarks/fakes.py), so no tokens
+or network are needed. Everything between the handler and the two APIs is the
+real code: user queue, admission, key pool, chat sessions, stream rendering,
+the Telegram outbox and the conversation store.
+
+Reports where the time to the first words goes (placeholder reply, first
+model chunk, first answer text on screen), time to the full answer, edits
+per answer, event-loop lag and CPU time per answer. Use --telegram-latency
+to see how much of the Telegram round-trips overlap with the model request.
+
+Usage: python -m benchmarks.load_bench [--users N] [--turns N] [--rate-limit-every N] ...
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot.types import Message
+
+from benchmarks import fakes
+from config import conf
+import keypool
+
+keypool.genai = SimpleNamespace(Client=fakes.FakeClient)
+
+import gemini
+import handlers
+
+# Every simulated user is let in, as if the bot were public
+handlers.is_owner = lambda message: True
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def make_message(user_id, message_id, text):
+    return Message.de_json({
+        "message_id": message_id,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "chat": {"id": user_id, "type": "private"},
+        "date": int(time.time()),
+        "text": text,
+    })
+
+
+async def measure_loop_lag(samples, interval=0.01):
+    """Record how late the event loop wakes a task that sleeps for interval"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+PLACEHOLDER = "🤖 Generating answers..."
+
+
+async def simulate_user(bot, user_id, turns, think_time, turn_stats):
+    for turn in range(turns):
+        chat_calls = len(bot.calls)
+        text = f"Question {turn} from {user_id}"
+        started = time.monotonic()
+        await handlers.gemini_private_handler(make_message(user_id, turn + 1, text), bot)
+        finished = time.monotonic()
+        calls = [call for call in bot.calls[chat_calls:] if call[2] == user_id]
+        replies = [at for at, method, _, _, _ in calls if method == "reply_to"]
+        edits = [at for at, method, _, _, _ in calls if method == "edit_message_text"]
+        # The reply itself carries the first words if they were ready before the placeholder went out
+        texts = [at for at, method, _, _, sent in calls if method == "edit_message_text" or (method == "reply_to" and sent != PLACEHOLDER)]
+        first_chunk = fakes.settings.first_chunks.get(text)
+        turn_stats.append(SimpleNamespace(
+            reply=replies[0] - started if replies else None,
+            first_chunk=first_chunk - started if first_chunk else None,
+            first_text=texts[0] - started if texts else None,
+            direct=bool(replies) and replies[0] == texts[0] if texts else False,
+            total=finished - started,
+            edits=len(edits),
+        ))
+        if think_time:
+            await asyncio.sleep(think_time)
+
+
+async def run(args):
+    settings = fakes.settings
+    settings.answer_chars = args.answer_chars
+    settings.chunk_chars = args.chunk_chars
+    settings.chunk_delay = args.chunk_delay
+    settings.first_chunk_delay = args.first_chunk_delay
+    settings.rate_limit_every = args.rate_limit_every
+    conf["streaming_update_interval"] = args.update_interval
+    gemini.key_pool.cooldown = args.key_cooldown
+    conf["quota_tier"] = args.quota_tier
+    gemini.key_pool.quota = gemini.new_quota_tracker()
+
+    gemini.initialize_key_pool([f"FAKE-KEY-{index:04d}" for index in range(args.keys)])
+    gemini.initialize_storage(args.db)
+    bot = fakes.FakeBot(latency=args.telegram_latency)
+
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag_samples))
+    turn_stats = []
+    cpu_started = time.process_time()
+    wall_started = time.monotonic()
+    await asyncio.gather(*[
+        simulate_user(bot, 1_000_000 + user, args.turns, args.think_time, turn_stats)
+        for user in range(args.users)
+    ])
+    wall = time.monotonic() - wall_started
+    cpu = time.process_time() - cpu_started
+    lag_task.cancel()
+
+    answers = len(turn_stats)
+    methods = {}
+    for _, method, _, _, _ in bot.calls:
+        methods[method] = methods.get(method, 0) + 1
+
+    def report(label, values):
+        values = [value for value in values if value is not None]
+        print(f"{label:<20} p50 {percentile(values, 0.5) * 1000:8.1f} ms   p99 {percentile(values, 0.99) * 1000:8.1f} ms")
+
+    print(f"users {args.users}, turns {args.turns}, answers {answers}, wall {wall:.2f}s, {answers / wall:.1f} answers/s")
+    report("placeholder sent", [stat.reply for stat in turn_stats])
+    report("first model chunk", [stat.first_chunk for stat in turn_stats])
+    report("first answer text", [stat.first_text for stat in turn_stats])
+    report("time to full answer", [stat.total for stat in turn_stats])
+    print(f"replies with text    {sum(stat.direct for stat in turn_stats)} of {answers} (first words beat the placeholder)")
+    print(f"edits per answer     mean {statistics.mean(stat.edits for stat in turn_stats):7.2f}      max {max(stat.edits for stat in turn_stats):5d}")
+    print(f"event loop lag       p50 {percentile(lag_samples, 0.5) * 1000:8.2f} ms   p99 {percentile(lag_samples, 0.99) * 1000:8.2f} ms   max {max(lag_samples, default=0) * 1000:.2f} ms")
+    print(f"cpu per answer       {cpu / max(answers, 1) * 1000:8.2f} ms ({cpu:.2f}s total)")
+    print(f"gemini requests      {settings.requests} ({settings.rate_limited} answered 429)")
+    print("telegram calls       " + ", ".join(f"{method} {count}" for method, count in sorted(methods.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3, help="messages each user sends, one after another")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a user waits between messages")
+    parser.add_argument("--keys", type=int, default=3, help="fake API keys in the pool")
+    parser.add_argument("--answer-chars", type=int, default=2000)
+    parser.add_argument("--chunk-chars", type=int, default=60)
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--first-chunk-delay", type=float, default=0.3, help="seconds before the first chunk")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth Gemini request with 429")
+    parser.add_argument("--key-cooldown", type=float, default=1.0, help="seconds a key sits out after a 429")
+    parser.add_argument("--quota-tier", default=None, help="enforce this tier's per-key rate limits locally (default: off)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds each fake Telegram call takes")
+    parser.add_argument("--update-interval", type=float, default=conf["streaming_update_interval"])
+    parser.add_argument("--db", default=":memory:", help="conversation database (default: in memory)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
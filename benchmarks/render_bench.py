@@ -0,0 +1,71 @@
+"""Micro-benchmark for the streaming MarkdownV2 renderer.
+
+Feeds a synthetic answer in small chunks and times one render per tick, once
+with the incremental StreamRenderer and once with the old approach of
+re-escaping the whole accumulated answer. Each row is the mean over the ticks
+since the previous row.
+
+Usage: python -m benchmarks.render_bench [--paragraphs N] [--chunk-size N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from md2tgmd import escape
+from render import StreamRenderer
+
+PARAGRAPH = (
+    "Here is **some** text with `inline code`, a [link](https://example.com) "
+    "and punctuation (like this). It goes on for a while - long enough to look "
+    "like a real answer.\n\n"
+    "```python\ndef f(x):\n    return x * 2\n```\n\n"
+    "- first item\n- second item\n\n"
+)
+
+
+def chunks(text, size):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def run(paragraphs, chunk_size, ticks_per_report):
+    answer = PARAGRAPH * paragraphs
+    renderer = StreamRenderer()
+    full_response = ""
+    rows = []
+    incremental_total = full_total = 0.0
+    for tick, chunk in enumerate(chunks(answer, chunk_size), 1):
+        renderer.feed(chunk)
+        full_response += chunk
+
+        start = time.perf_counter()
+        renderer.render()
+        incremental_total += time.perf_counter() - start
+
+        start = time.perf_counter()
+        escape(full_response)
+        full_total += time.perf_counter() - start
+
+        if tick % ticks_per_report == 0:
+            rows.append((len(full_response), incremental_total / ticks_per_report, full_total / ticks_per_report))
+            incremental_total = full_total = 0.0
+
+    print(f"{'answer chars':>12} {'incremental ms':>15} {'full escape ms':>15}  (mean per tick)")
+    for length, incremental, full in rows:
+        print(f"{length:>12} {incremental * 1000:>15.3f} {full * 1000:>15.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paragraphs", type=int, default=60)
+    parser.add_argument("--chunk-size", type=int, default=40)
+    parser.add_argument("--report-every", type=int, default=50)
+    args = parser.parse_args()
+    run(args.paragraphs, args.chunk_size, args.report_every)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,3 @@
-from google.genai import types
-
 # Default system prompt
 DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant. You should use web search to provide factual and up-to-date information, citing your sources."
 
@@ -38,7 +36,10 @@ lang_settings = {
         "api_quota_exhausted": "API key quota exhausted, switching to the next key...",
         "all_api_quota_exhausted": "All API key quotas are exhausted, please try again later or add a new API key.",
         "api_key_invalid_format": "Invalid API key format. The key should have at least 8 characters and contain only letters, numbers, and some special characters.",
-        "api_key_invalid": "Invalid API key. The key could not be verified with Google API."
+        "api_key_invalid": "Invalid API key. The key could not be verified with Google API.",
+        "queue_position": "⏳ Waiting in queue, position",
+        "overloaded": "The bot is overloaded right now, please try again in a minute.",
+        "retrying": "⏳ Gemini is busy, retrying..."
     }
 }
 
@@ -48,6 +49,76 @@ conf = {
     "model_2": "gemini-2.5-pro",  
     "model_3": "gemini-2.0-flash-preview-image-generation",  
     "streaming_update_interval": 0.5,  
+    "message_page_limit": 4000,  # Telegram rejects messages longer than 4096 characters
+    "telegram_global_rate": 30,  # outgoing requests per second across all chats
+    "telegram_chat_rate": 1.0,  # outgoing requests per second per chat
+    "telegram_chat_burst": 3,
+    "api_key_cooldown": 60,  # seconds a key sits out after answering 429
+    "quota_tier": None,  # rate limits of the API keys, see quota_tiers; None (default) disables the local quota check
+    "quota_save_interval": 30,  # seconds between saves of the daily per-key counters
+    "shared_state_interval": 1.0,  # seconds between exchanges of key usage and cooldowns between worker processes
+    "model_concurrency": {"model_1": 32, "model_2": 8, "model_3": 4},  # model requests in flight, per model
+    "admission_total_limit": 40,  # model requests in flight across all models
+    "admission_deadline": 120,  # seconds a request may wait for its turn before it is turned away
+    "queue_position_interval": 2,  # seconds between queue position checks while waiting
+    "gemini_max_attempts": 4,  # tries per model call across keys and transient errors
+    "gemini_retry_deadline": 90,  # seconds after which a failing model call is no longer retried
+    "gemini_request_timeout": 120,  # seconds one non-streamed model request may take
+    "gemini_first_chunk_timeout": 90,  # seconds a streamed request may take to its first chunk before it is retried
+    "gemini_stream_idle_timeout": 60,  # seconds a stream may go without a chunk before it is retried
+    "hedge_enabled": False,  # resend a chat turn on another key when its first token is slow (needs 2+ keys)
+    "hedge_delay": None,  # seconds before hedging; None uses the rolling p95 time-to-first-token
+    "hedge_min_delay": 2.0,
+    "hedge_max_ratio": 0.1,  # share of recent requests that may be hedged
+    "session_max_entries": 5000,  # chat sessions kept per model
+    "session_max_bytes": 512 * 1024 * 1024,  # history text and inline images kept per model
+    "session_idle_ttl": 24 * 3600,  # seconds before an idle chat session is dropped
+    "settings_max_entries": 100000,  # per-user settings (default model, system prompt)
+    "settings_idle_ttl": 90 * 24 * 3600,
+    "conversation_db": "conversations.db",  # SQLite file for chat history and system prompts
+    "state_file": "bot_state.json",  # small JSON file of startup state, e.g. the hash of the registered commands
+    "context_cache_min_tokens": {"model_1": 1024, "model_2": 4096},  # system prompts at least this long are sent as cached content
+    "context_cache_ttl": 3600,  # seconds; extended while the cache is in use
+    "context_cache_max_entries": 200,
+    "history_token_budget": 32000,  # estimated prompt tokens of history before older turns are compacted
+    "history_keep_ratio": 0.5,  # share of the budget kept verbatim as recent turns when compacting
+    "history_summarize": True,  # summarize compacted turns with model_1; False just drops them
+    "image_max_edge": 1536,  # photos are downscaled to this longest edge before upload
+    "image_jpeg_quality": 85,
+    "image_workers": 4,  # threads decoding and encoding photos
+    "photo_cache_bytes": 64 * 1024 * 1024,  # downloaded and preprocessed photos kept in memory
+    "photo_cache_dir": None,  # set to a directory to also keep photos on disk
+    "photo_cache_disk_bytes": 1024 * 1024 * 1024,
+    "album_window": 0.8,  # seconds without a new photo before an album is answered as a whole
+    "merge_messages": True,  # merge text messages sent while an earlier one is still waiting into a single prompt
+    "merge_window": 0,  # seconds a plain text message waits for follow-ups to merge into one prompt; 0 merges only while busy
+    "update_handlers": 1000,  # updates handled concurrently in webhook and worker mode, most of them waiting for their user's queue or admission
+    "webhook_queue_size": 1000,
+    "poll_timeout": 25,  # seconds a long poll for updates waits on Telegram's side
+    "worker_restart_delay": 1,  # seconds before a crashed worker process is started again; doubles while it keeps crashing
+    "stale_update_policy": "answer",  # messages sent before a restart: "answer", "skip", or "recent" (answer only those younger than stale_update_max_age)
+    "stale_update_max_age": 600,  # seconds
+    "update_log_size": 10000,  # handled update ids remembered per bot to drop redeliveries
+}
+
+# Gemini API rate limits per usage tier, keyed by the model's conf name:
+# requests per minute, prompt tokens per minute and requests per day
+quota_tiers = {
+    "free": {
+        "model_1": {"rpm": 10, "tpm": 250000, "rpd": 250},
+        "model_2": {"rpm": 5, "tpm": 250000, "rpd": 100},
+        "model_3": {"rpm": 10, "tpm": 200000, "rpd": 100},
+    },
+    "tier1": {
+        "model_1": {"rpm": 1000, "tpm": 1000000, "rpd": 10000},
+        "model_2": {"rpm": 150, "tpm": 2000000, "rpd": 10000},
+        "model_3": {"rpm": 1000, "tpm": 1000000, "rpd": 10000},
+    },
+    "tier2": {
+        "model_1": {"rpm": 2000, "tpm": 3000000, "rpd": 100000},
+        "model_2": {"rpm": 1000, "tpm": 5000000, "rpd": 50000},
+        "model_3": {"rpm": 2000, "tpm": 3000000, "rpd": 100000},
+    },
 }
 
 
@@ -55,27 +126,13 @@ default_lang = conf["default_language"]
 conf.update(lang_settings[default_lang])
 
 
+# Plain dicts, so config does not have to import google.genai.types
 safety_settings = [
-    types.SafetySetting(
-        category="HARM_CATEGORY_HARASSMENT",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_HATE_SPEECH",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_CIVIC_INTEGRITY",
-        threshold="BLOCK_NONE",
-    )
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"},
 ]
 
 
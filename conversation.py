@@ -0,0 +1,59 @@
+from lazy import types
+
+
+def user_content(message):
+    """The user turn for message, given as text or as a list of parts"""
+    if isinstance(message, str):
+        return types.Content(role="user", parts=[types.Part.from_text(text=message)])
+    return types.Content(role="user", parts=list(message))
+
+
+def _plain_text(part):
+    return part.text is not None and not part.thought and part.thought_signature is None
+
+
+def merge_text(parts):
+    """Join the adjacent text parts of a streamed answer into one part each"""
+    merged = []
+    for part in parts:
+        if merged and _plain_text(part) and _plain_text(merged[-1]):
+            merged[-1] = types.Part.from_text(text=merged[-1].text + part.text)
+        else:
+            merged.append(part)
+    return merged
+
+
+class Conversation:
+    """A chat's history as plain types.Content, not tied to any API key.
+
+    Every turn sends the whole history with whichever client the caller
+    picked, so a turn can be retried or continued on another key with full
+    context. A turn only joins the history once its answer has streamed to
+    the end; a failed or cancelled attempt leaves the history unchanged.
+    """
+
+    def __init__(self, history=None):
+        self.history = list(history or [])
+
+    def get_history(self):
+        return list(self.history)
+
+    def append(self, *contents):
+        self.history.extend(contents)
+
+    async def send_message_stream(self, client, model, message, config):
+        """Send message after the history and return the stream of response chunks"""
+        content = user_content(message)
+        stream = await client.aio.models.generate_content_stream(model=model, contents=[*self.history, content], config=config)
+        return self._record(content, stream)
+
+    async def _record(self, content, stream):
+        parts = []
+        async for chunk in stream:
+            candidates = getattr(chunk, "candidates", None)
+            if candidates and candidates[0].content is not None and candidates[0].content.parts:
+                parts.extend(candidates[0].content.parts)
+            yield chunk
+        # An empty (e.g. blocked) answer is not kept, like an invalid turn in a chat session
+        if parts:
+            self.append(content, types.Content(role="model", parts=merge_text(parts)))
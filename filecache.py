@@ -0,0 +1,96 @@
+import asyncio
+import os
+from config import conf
+from sessions import SessionStore
+from metrics import telegram_download_seconds
+
+
+class FileCache:
+    """Byte cache keyed by Telegram's file_unique_id.
+
+    Hot entries live in a memory LRU capped at max_bytes; if disk_dir is set,
+    entries are also written there (capped at disk_max_bytes, oldest first out)
+    and promoted back into memory on a hit.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=None):
+        self._memory = SessionStore(max_bytes=max_bytes, sizeof=len)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._disk_sizes = {}  # file name -> size, oldest first
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            entries = [entry for entry in os.scandir(disk_dir) if entry.is_file()]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                self._disk_sizes[entry.name] = entry.stat().st_size
+
+    @staticmethod
+    def _file_name(key):
+        return "".join(c if c.isalnum() or c in "-_." else "_" for c in key)
+
+    async def get(self, key):
+        """Return the cached bytes for key, or None"""
+        data = self._memory.get(key)
+        if data is None and self.disk_dir and self._file_name(key) in self._disk_sizes:
+            try:
+                data = await asyncio.to_thread(self._read, self._file_name(key))
+                self._memory[key] = data
+            except OSError:
+                self._disk_sizes.pop(self._file_name(key), None)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    async def put(self, key, data):
+        self._memory[key] = data
+        if self.disk_dir:
+            name = self._file_name(key)
+            try:
+                await asyncio.to_thread(self._write, name, data)
+            except OSError as e:
+                print(f"Error writing file cache entry: {e}")
+                return
+            # The bookkeeping stays on the event loop; only file I/O runs in threads
+            self._disk_sizes.pop(name, None)
+            self._disk_sizes[name] = len(data)
+            evicted = []
+            total = sum(self._disk_sizes.values())
+            while self.disk_max_bytes and len(self._disk_sizes) > 1 and total > self.disk_max_bytes:
+                oldest = next(iter(self._disk_sizes))
+                total -= self._disk_sizes.pop(oldest)
+                evicted.append(oldest)
+            if evicted:
+                await asyncio.to_thread(self._remove, evicted)
+
+    def _read(self, name):
+        with open(os.path.join(self.disk_dir, name), "rb") as f:
+            return f.read()
+
+    def _write(self, name, data):
+        with open(os.path.join(self.disk_dir, name), "wb") as f:
+            f.write(data)
+
+    def _remove(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+
+
+photo_cache = FileCache(conf["photo_cache_bytes"], conf["photo_cache_dir"], conf["photo_cache_disk_bytes"])
+
+
+async def download_photo(bot, photo):
+    """Download a Telegram PhotoSize, or reuse the bytes of an earlier download of the same file"""
+    data = await photo_cache.get(photo.file_unique_id)
+    if data is None:
+        with telegram_download_seconds.time():
+            file_path = await bot.get_file(photo.file_id)
+            data = await bot.download_file(file_path.file_path)
+        await photo_cache.put(photo.file_unique_id, data)
+    return data
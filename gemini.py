@@ -1,27 +1,29 @@
+import asyncio
+import contextvars
 import io
 import time
 import traceback
-from PIL import Image
 from telebot.types import Message
-from md2tgmd import escape
 from telebot import TeleBot
-from config import conf, generation_config, draw_generation_config, lang_settings, DEFAULT_SYSTEM_PROMPT, safety_settings
-from google import genai
-from google.genai import types
+from config import conf, generation_config, draw_generation_config, lang_settings, DEFAULT_SYSTEM_PROMPT, safety_settings, quota_tiers
+from lazy import types
+import outbox
+import metrics
+from admission import Admission, Shed, PRIORITY_CHAT, PRIORITY_VISION, PRIORITY_IMAGE, PRIORITY_BACKGROUND
+from keypool import KeyPool
+from quota import QuotaTracker, key_id, today
+from retry import RetryExecutor, NoKeyAvailable, classify, PERMANENT, QUOTA, server_retry_delay
+from promptcache import PromptCache
+from hedging import HedgePolicy
+from images import preprocess_image
+from render import StreamPager, paginate
+from tenants import Tenant
+from storage import ConversationStore
+from conversation import Conversation, user_content
+from history import SUMMARY_PROMPT, dropped_contents, estimate_tokens, split_point, summary_contents, transcript, trim
 
 
-api_keys = []  # To be populated from main.py
-current_api_key_index = 0 
-
-gemini_draw_dict = {}
-gemini_chat_dict = {}
-gemini_pro_chat_dict = {}
-default_model_dict = {}
-user_system_prompt_dict = {}  # User system prompts dictionary
-
-model_1                 =       conf["model_1"]
-model_2                 =       conf["model_2"]
-model_3                 =       conf["model_3"]
+default_models          =       {name: conf[name] for name in ("model_1", "model_2", "model_3")}
 default_language        =       conf["default_language"]
 error_info              =       conf["error_info"]
 before_generate_info    =       conf["before_generate_info"]
@@ -29,45 +31,122 @@ download_pic_notify     =       conf["download_pic_notify"]
 
 search_tool = {'google_search': {}}
 
-# Client will be initialized in main.py
-client = None
+def quota_limits(models):
+    """conf's quota tier keyed by model name; models maps conf names (model_1...) to model names"""
+    return {models[name]: limits for name, limits in quota_tiers[conf["quota_tier"]].items()}
 
-def initialize_client():
-    """Initializes the genai client after keys are loaded."""
-    global client
-    if api_keys:
-        try:
-            client = genai.Client(api_key=api_keys[current_api_key_index])
-            print("Gemini client initialized successfully.")
-        except Exception as e:
-            print(f"Error initializing Gemini client: {e}")
+def new_quota_tracker(models=None):
+    """Local rate-limit model for conf's quota tier, or None if the check is off"""
+    if conf["quota_tier"] is None:
+        return None
+    return QuotaTracker(quota_limits(models or default_models))
+
+def new_retry_executor(pool):
+    return RetryExecutor(pool, conf["gemini_max_attempts"], conf["gemini_retry_deadline"])
+
+# One client per API key; keys are added from main.py. Shared by every bot without keys of its own
+key_pool = KeyPool(conf["api_key_cooldown"], new_quota_tracker())
+api_keys = key_pool.keys
+
+# Every model call goes through this: key choice, cooldowns and retries
+retry_executor = new_retry_executor(key_pool)
+
+# Long system prompts are uploaded once per key and model as cached content
+prompt_cache = PromptCache(
+    conf["context_cache_ttl"],
+    {conf[name]: tokens for name, tokens in conf["context_cache_min_tokens"].items()},
+    conf["context_cache_max_entries"],
+)
+
+# A chat turn whose first token is slow may be duplicated on another key
+hedge_policy = HedgePolicy(conf["hedge_enabled"], conf["hedge_delay"], conf["hedge_min_delay"], conf["hedge_max_ratio"])
+
+# Bounds the model requests in flight; limits in conf are keyed by the model's conf name
+admission = Admission(
+    {conf[name]: limit for name, limit in conf["model_concurrency"].items()},
+    conf["admission_total_limit"],
+    conf["admission_deadline"],
+)
+
+# Every bot served by this process, see new_tenant()
+tenants = []
+
+def new_tenant(name, owner_id=None, models=None, system_prompt=None, keys=None):
+    """Add a bot to serve from this process and return its Tenant.
+
+    models maps conf names (model_1, model_2, model_3) to the bot's own
+    models, defaulting to conf's. Without keys of its own, the bot uses the
+    shared key pool.
+    """
+    models = {**default_models, **(models or {})}
+    if keys is None:
+        pool, executor = key_pool, retry_executor
+    else:
+        pool = KeyPool(conf["api_key_cooldown"], new_quota_tracker(models))
+        executor = new_retry_executor(pool)
+    tenant = Tenant(name, owner_id, models, system_prompt or DEFAULT_SYSTEM_PROMPT, pool, executor)
+    # A shared pool and the admission limits learn the bot's models under their conf names' limits
+    if pool.quota is not None:
+        for model, limits in quota_limits(models).items():
+            pool.quota.limits.setdefault(model, limits)
+    for conf_name, limit in conf["model_concurrency"].items():
+        admission.limits.setdefault(models[conf_name], limit)
+    tenants.append(tenant)
+    if keys is not None:
+        initialize_key_pool(keys, pool)
+    return tenant
+
+# The bot in a single-bot process
+default_tenant = new_tenant("default")
+
+# The bot whose update is being handled; main.py sets it for each bot's updates
+current_tenant = contextvars.ContextVar("current_tenant", default=default_tenant)
+
+def session_counts():
+    counts = {}
+    for tenant in tenants:
+        for model, store in ((tenant.model_1, tenant.gemini_chat_dict), (tenant.model_2, tenant.gemini_pro_chat_dict), (tenant.model_3, tenant.gemini_draw_dict)):
+            counts[(model,)] = counts.get((model,), 0) + len(store)
+    return counts
+
+def key_pools():
+    """The distinct key pools of all tenants"""
+    return list({id(tenant.key_pool): tenant.key_pool for tenant in tenants}.values())
+
+# Gauges read when /metrics is scraped
+metrics.Gauge("bot_active_sessions", "Chat sessions held in memory", ("model",), session_counts)
+metrics.Gauge("gemini_requests_in_flight", "Model requests admitted and not finished", ("model",),
+              lambda: {(model,): count for model, count in admission.active.items()})
+metrics.Gauge("gemini_requests_waiting", "Model requests waiting for admission", ("model",),
+              lambda: {(model,): admission.queued(model) for model in {model for tenant in tenants for model in tenant.models}})
+metrics.Gauge("gemini_key_requests_in_flight", "Requests in flight per API key", ("key",),
+              lambda: {(slot.label,): slot.in_flight for pool in key_pools() for slot in pool.slots})
+metrics.Gauge("gemini_hedged_ratio", "Share of the recent chat requests that were hedged; capped at hedge_max_ratio", (),
+              lambda: {(): hedge_policy.ratio()})
+metrics.Gauge("telegram_outbox_queue_depth", "Telegram requests waiting to be sent", (),
+              lambda: {(): outbox.queue_depth()})
+
+def initialize_key_pool(keys, pool=None):
+    """Create a client for every API key loaded from the environment (or a bot's configuration)."""
+    if pool is None:
+        pool = key_pool
+    for key in keys:
+        if not add_api_key(key, pool):
+            print(f"Skipping invalid or duplicate API key #{len(pool)}")
+    print(f"Gemini key pool initialized with {len(pool)} key(s).")
 
 # API KEY management functions
-def get_current_api_key():
-    """Get the currently used API key"""
-    if not api_keys:
-        return None
-    return api_keys[current_api_key_index]
+def is_quota_error(e):
+    """Whether an exception from the Gemini API means the key ran out of quota"""
+    return classify(e) == QUOTA
 
-def switch_to_next_api_key():
-    """Switch to the next available API key"""
-    global current_api_key_index, client
-    if len(api_keys) <= 1:
-        return False
-    
-    original_index = current_api_key_index
-    current_api_key_index = (current_api_key_index + 1) % len(api_keys)
-    
-    if current_api_key_index == original_index:
-        return False
-    
-    try:
-        client = genai.Client(api_key=api_keys[current_api_key_index])
-        print(f"Successfully switched to API key #{current_api_key_index}")
-        return True
-    except Exception as e:
-        print(f"Error switching to next API key: {e}")
-        return switch_to_next_api_key()
+def release_failed(slot, e):
+    """Give back a key whose request raised e, cooling it down if it ran out of quota"""
+    pool = current_tenant.get().key_pool
+    if is_quota_error(e):
+        pool.release(slot, "rate_limited", retry_after=server_retry_delay(e))
+    else:
+        pool.release(slot, "error")
 
 def validate_api_key_format(key):
     """Validate API key format (simple check)"""
@@ -76,76 +155,292 @@ def validate_api_key_format(key):
     valid_chars = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-.")
     return all(c in valid_chars for c in key)
 
-def add_api_key(key):
-    """Add a new API key"""
-    global client
+def add_api_key(key, pool=None):
+    """Add a new API key to pool (default: the current bot's)"""
+    if pool is None:
+        pool = current_tenant.get().key_pool
     key = key.strip()
     if not validate_api_key_format(key):
         return False
-    if key not in api_keys:
-        api_keys.append(key)
-        if len(api_keys) == 1:
-            try:
-                client = genai.Client(api_key=key)
-                return True
-            except Exception as e:
-                print(f"Error initializing client with new API key: {e}")
-                api_keys.pop()
-                return False
+    if key in pool.keys:
+        return False
+    try:
+        pool.add(key)
         return True
-    return False
+    except Exception as e:
+        print(f"Error initializing client with new API key: {e}")
+        return False
 
 def remove_api_key(key):
     """Remove a specified API key"""
-    global current_api_key_index, client
-    if key in api_keys:
-        index = api_keys.index(key)
-        api_keys.remove(key)
-        if not api_keys:
-            current_api_key_index = 0
-            client = None
-            return True
-        if index == current_api_key_index:
-            if index >= len(api_keys):
-                current_api_key_index = len(api_keys) - 1
-            client = genai.Client(api_key=api_keys[current_api_key_index])
-        elif index < current_api_key_index:
-            current_api_key_index -= 1
+    pool = current_tenant.get().key_pool
+    if key in pool.keys:
+        pool.remove(key)
+        prompt_cache.forget_key(key)
         return True
     return False
 
-def list_api_keys():
-    """List all API keys (masked)"""
+def mask_api_key(key):
+    if len(key) > 8:
+        visible_part = len(key) // 4
+        if visible_part < 2:
+            visible_part = 2
+        return key[:visible_part] + "*" * (len(key) - visible_part*2) + key[-visible_part:]
+    return key[0] + "*" * (max(len(key) - 2, 1)) + (key[-1] if len(key) > 1 else "")
+
+def list_api_keys(stats=False):
+    """List all API keys (masked), optionally with their usage counters"""
+    tenant = current_tenant.get()
+    pool = tenant.key_pool
     masked_keys = []
-    for i, key in enumerate(api_keys):
-        if len(key) > 8:
-            visible_part = len(key) // 4
-            if visible_part < 2:
-                visible_part = 2
-            masked_key = key[:visible_part] + "*" * (len(key) - visible_part*2) + key[-visible_part:]
-        else:
-            masked_key = key[0] + "*" * (max(len(key) - 2, 1)) + (key[-1] if len(key) > 1 else "")
-        if i == current_api_key_index:
+    for i, slot in enumerate(pool.slots):
+        masked_key = mask_api_key(slot.key)
+        if i == pool.preferred:
             masked_key = f"[Current] {masked_key}"
+        if stats:
+            masked_key += f" | in flight: {slot.in_flight}, ok: {slot.success}, 429: {slot.rate_limited}, errors: {slot.errors}"
+            cooldown = slot.cooldown_left()
+            if cooldown:
+                masked_key += f", cooling down: {cooldown:.0f}s"
+            if pool.quota is not None:
+                requests_today = sum(pool.quota.usage_today(slot.key, model)[0] for model in tenant.models)
+                masked_key += f", today: {requests_today}"
         masked_keys.append(masked_key)
     return masked_keys
 
 def set_current_api_key(index):
-    """Set the current API key by index"""
-    global current_api_key_index, client
-    if 0 <= index < len(api_keys):
+    """Prefer the API key at index and clear its cooldown"""
+    pool = current_tenant.get().key_pool
+    if 0 <= index < len(pool):
+        pool.preferred = index
+        pool.reset_cooldown(index)
+        return True
+    return False
+
+def initialize_storage(path, tenant=None):
+    """Open the SQLite conversation store of tenant (default: the current bot)."""
+    tenant = tenant or current_tenant.get()
+    tenant.conversation_store = ConversationStore(path)
+    print(f"Conversation store opened at {path}.")
+    if tenant.key_pool.quota is not None:
+        tenant.key_pool.quota.restore(tenant.api_keys, tenant.conversation_store.load_key_usage(today()))
+
+# Index of this worker process in a sharded bot, None when running alone
+shard_index = None
+
+def initialize_shard(index, count):
+    """Run as worker index of count processes sharing the API keys (see shards.py).
+
+    Call before initialize_storage() so each worker restores its own daily
+    counters. The Telegram global send rate is split evenly between workers.
+    """
+    global shard_index
+    shard_index = index
+    if key_pool.quota is not None:
+        key_pool.quota.worker = index
+    rate = conf["telegram_global_rate"] / count
+    outbox.outbox.global_bucket = outbox.TokenBucket(rate, rate)
+
+async def sync_key_state():
+    """Keep exchanging API key usage and cooldowns with the other workers of a sharded bot"""
+    tenant = current_tenant.get()
+    pool = tenant.key_pool
+    while True:
+        now, wall = time.monotonic(), time.time()
+        usage = [(key_id(key), model, *counts) for key, model, *counts in pool.quota.snapshot()] if pool.quota is not None else []
+        cooldowns = {key_id(slot.key): wall + slot.cooldown_left(now) for slot in pool.slots if slot.cooldown_left(now)}
         try:
-            old_index = current_api_key_index
-            test_client = genai.Client(api_key=api_keys[index])
-            current_api_key_index = index
-            client = test_client
-            return True
+            others, running = await asyncio.to_thread(tenant.conversation_store.exchange_key_state, shard_index, usage, cooldowns)
         except Exception as e:
-            print(f"Error switching to API key at index {index}: {e}")
-            return False
-    return False
+            print(f"Error sharing API key state: {e}")
+        else:
+            apply_shared_key_state(pool, others, running)
+        await asyncio.sleep(conf["shared_state_interval"])
+
+def apply_shared_key_state(pool, others, running):
+    """Add the other workers' usage to pool's quota checks and adopt their cooldowns"""
+    slots = {key_id(slot.key): slot for slot in pool.slots}
+    now, wall = time.monotonic(), time.time()
+    for saved_id, until in running.items():
+        slot = slots.get(saved_id)
+        if slot is not None:
+            slot.cooldown_until = max(slot.cooldown_until, now + until - wall)
+    if pool.quota is None:
+        return
+    day = today()
+    totals = {}
+    for saved_id, model, requests, tokens, saved_day, requests_today in others:
+        slot = slots.get(saved_id)
+        if slot is None:
+            continue
+        previous = totals.get((slot.key, model), (0, 0, 0))
+        totals[(slot.key, model)] = (previous[0] + requests, previous[1] + tokens, previous[2] + (requests_today if saved_day == day else 0))
+    pool.quota.others = totals
+
+def record_key_usage(slot, model, usage_metadata):
+    """Count a response's tokens against slot's quota and now and then save the daily counters"""
+    tenant = current_tenant.get()
+    pool = tenant.key_pool
+    pool.record_usage(slot, model, usage_metadata)
+    if tenant.conversation_store is None or pool.quota is None:
+        return
+    now = time.monotonic()
+    if now - tenant.last_usage_save < conf["quota_save_interval"]:
+        return
+    tenant.last_usage_save = now
+    rows = pool.quota.changed_rows()
+    if rows:
+        task = asyncio.create_task(save_key_usage(tenant.conversation_store, rows))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def save_key_usage(store, rows):
+    try:
+        await asyncio.to_thread(store.save_key_usage, rows)
+    except Exception as e:
+        print(f"Error saving API key usage: {e}")
+
+async def load_history(user_id, model_name):
+    """Read a user's persisted history, e.g. after a restart"""
+    store = current_tenant.get().conversation_store
+    if store is None:
+        return None
+    try:
+        return await asyncio.to_thread(store.load_history, user_id, model_name)
+    except Exception as e:
+        print(f"Error loading conversation history: {e}")
+        return None
+
+async def record_turn(user_id, model_name, user_parts, answer):
+    """Append a finished user/model turn to the persistent log"""
+    store = current_tenant.get().conversation_store
+    if store is None or not answer:
+        return
+    contents = [
+        types.Content(role="user", parts=user_parts),
+        types.Content(role="model", parts=[types.Part.from_text(text=answer)]),
+    ]
+    try:
+        await asyncio.to_thread(store.append_turn, user_id, model_name, contents)
+    except Exception as e:
+        print(f"Error recording conversation turn: {e}")
+
+async def forget_chats(user_id_str):
+    """Drop the user's text chat sessions, in memory and in the persistent log"""
+    tenant = current_tenant.get()
+    # The log first: a session dropped before it is cleared could be read back from it
+    if tenant.conversation_store is not None:
+        try:
+            await asyncio.to_thread(tenant.conversation_store.clear, user_id_str, [tenant.model_1, tenant.model_2])
+        except Exception as e:
+            print(f"Error clearing conversation history: {e}")
+    if user_id_str in tenant.gemini_chat_dict:
+        del tenant.gemini_chat_dict[user_id_str]
+    if user_id_str in tenant.gemini_pro_chat_dict:
+        del tenant.gemini_pro_chat_dict[user_id_str]
+    for model_name in (tenant.model_1, tenant.model_2):
+        tenant.pending_compactions.pop((model_name, user_id_str), None)
+
+async def chat_config(slot, model_name, user_id):
+    """GenerateContentConfig for a chat turn on slot's key, with the user's system prompt cached if it is long"""
+    return await prompt_cache.config(slot, model_name, await get_system_prompt(user_id), [search_tool])
+
+async def get_chat(chat_dict, user_id, model_name):
+    """Return the user's conversation with model_name.
+
+    Conversations are plain history, so any key can send the next turn. The
+    history is read back from the persistent log the first time the user
+    writes after a restart, and a finished background compaction is applied
+    here, between turns.
+    """
+    chat = chat_dict.get(user_id)
+    if chat is None:
+        history = await load_history(user_id, model_name)
+        if history:
+            history = trim(history, conf["history_token_budget"], conf["history_keep_ratio"])
+        chat = chat_dict[user_id] = Conversation(history)
+    compaction = current_tenant.get().pending_compactions.pop((model_name, user_id), None)
+    if compaction is not None:
+        compacted = apply_compaction(chat.history, compaction)
+        if compacted is not None:
+            chat.history = compacted
+            await rewrite_history(user_id, model_name, compacted)
+    return chat
+
+# History compaction: once a chat's history is over its token budget, the older
+# turns are summarized in the background and swapped in before the next turn
+# (see the tenant's pending_compactions).
+background_tasks = set()
+
+def apply_compaction(history, compaction):
+    """Return history with its summarized prefix replaced, or None if the prefix no longer matches"""
+    count, last_replaced, replacement = compaction
+    if len(history) < count or history[count - 1] != last_replaced:
+        return None
+    return replacement + history[count:]
+
+async def rewrite_history(user_id, model_name, history):
+    store = current_tenant.get().conversation_store
+    if store is None:
+        return
+    try:
+        await asyncio.to_thread(store.rewrite, user_id, model_name, history)
+    except Exception as e:
+        print(f"Error saving compacted history: {e}")
+
+def schedule_compaction(user_id, model_name, chat):
+    """Start compacting the chat's older turns if its history is over the token budget"""
+    tenant = current_tenant.get()
+    key = (model_name, user_id)
+    if key in tenant.compacting or key in tenant.pending_compactions:
+        return
+    budget = conf["history_token_budget"]
+    history = chat.get_history()
+    if estimate_tokens(history) <= budget:
+        return
+    split = split_point(history, int(budget * conf["history_keep_ratio"]))
+    if split == 0:
+        return
+    tenant.compacting.add(key)
+    task = asyncio.create_task(compact_history(tenant, key, history[:split]))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def compact_history(tenant, key, old_contents):
+    try:
+        replacement = dropped_contents()
+        if conf["history_summarize"]:
+            summary = await summarize_history(old_contents)
+            if summary:
+                replacement = summary_contents(summary)
+        tenant.pending_compactions[key] = (len(old_contents), old_contents[-1], replacement)
+    finally:
+        tenant.compacting.discard(key)
+
+async def summarize_history(contents):
+    """Summarize old turns with the flash model; returns None if no key is free or the call fails"""
+    tenant = current_tenant.get()
+    model_1 = tenant.model_1
+    try:
+        await admission.acquire(model_1, PRIORITY_BACKGROUND)
+    except Shed:
+        return None
+
+    async def summarize(attempt):
+        started = time.perf_counter()
+        response = await attempt.slot.client.aio.models.generate_content(model=model_1, contents=SUMMARY_PROMPT + transcript(contents))
+        observe_response(model_1, started, response, attempt.slot)
+        return response
+
+    try:
+        response = await tenant.retry_executor.run(summarize, model_1, estimate_tokens(contents), timeout=conf["gemini_request_timeout"])
+    except Exception as e:
+        print(f"Error summarizing history: {e}")
+        return None
+    finally:
+        admission.release(model_1)
+    return response.text
 
-# Since there is only one language, these are simplified
 def get_user_lang(user_id):
     return default_language
 
@@ -153,42 +448,58 @@ def get_user_text(user_id, text_key):
     return lang_settings[default_language].get(text_key, "")
 
 # System Prompt Management
-def get_system_prompt(user_id):
-    return user_system_prompt_dict.get(str(user_id), DEFAULT_SYSTEM_PROMPT)
+async def get_system_prompt(user_id):
+    tenant = current_tenant.get()
+    user_id_str = str(user_id)
+    if user_id_str not in tenant.user_system_prompt_dict and tenant.conversation_store is not None:
+        try:
+            prompt = await asyncio.to_thread(tenant.conversation_store.get_setting, user_id_str, "system_prompt")
+        except Exception as e:
+            print(f"Error loading system prompt: {e}")
+            return tenant.system_prompt
+        # A prompt set while this one was read wins
+        if user_id_str not in tenant.user_system_prompt_dict:
+            tenant.user_system_prompt_dict[user_id_str] = tenant.system_prompt if prompt is None else prompt
+    return tenant.user_system_prompt_dict.get(user_id_str, tenant.system_prompt)
+
+async def save_system_prompt(user_id_str, prompt):
+    store = current_tenant.get().conversation_store
+    if store is None:
+        return
+    try:
+        await asyncio.to_thread(store.set_setting, user_id_str, "system_prompt", prompt)
+    except Exception as e:
+        print(f"Error saving system prompt: {e}")
 
 async def set_system_prompt(bot: TeleBot, message: Message, prompt: str):
     user_id_str = str(message.from_user.id)
-    user_system_prompt_dict[user_id_str] = prompt
-    if user_id_str in gemini_chat_dict:
-        del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict:
-        del gemini_pro_chat_dict[user_id_str]
+    current_tenant.get().user_system_prompt_dict[user_id_str] = prompt
+    await save_system_prompt(user_id_str, prompt)
+    await forget_chats(user_id_str)
     confirmation_msg = f"{get_user_text(message.from_user.id, 'system_prompt_set')}\n{prompt}"
-    await bot.reply_to(message, confirmation_msg)
+    await outbox.reply_to(bot, message, confirmation_msg)
 
 async def delete_system_prompt(bot: TeleBot, message: Message):
     user_id_str = str(message.from_user.id)
+    user_system_prompt_dict = current_tenant.get().user_system_prompt_dict
     if user_id_str in user_system_prompt_dict:
         del user_system_prompt_dict[user_id_str]
-    if user_id_str in gemini_chat_dict:
-        del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict:
-        del gemini_pro_chat_dict[user_id_str]
-    await bot.reply_to(message, get_user_text(message.from_user.id, 'system_prompt_deleted'))
+    await save_system_prompt(user_id_str, None)
+    await forget_chats(user_id_str)
+    await outbox.reply_to(bot, message, get_user_text(message.from_user.id, 'system_prompt_deleted'))
 
 async def reset_system_prompt(bot: TeleBot, message: Message):
     user_id_str = str(message.from_user.id)
-    user_system_prompt_dict[user_id_str] = DEFAULT_SYSTEM_PROMPT
-    if user_id_str in gemini_chat_dict:
-        del gemini_chat_dict[user_id_str]
-    if user_id_str in gemini_pro_chat_dict:
-        del gemini_pro_chat_dict[user_id_str]
-    await bot.reply_to(message, get_user_text(message.from_user.id, 'system_prompt_reset'))
+    tenant = current_tenant.get()
+    tenant.user_system_prompt_dict[user_id_str] = tenant.system_prompt
+    await save_system_prompt(user_id_str, None)
+    await forget_chats(user_id_str)
+    await outbox.reply_to(bot, message, get_user_text(message.from_user.id, 'system_prompt_reset'))
 
 async def show_system_prompt(bot: TeleBot, message: Message):
     user_id = message.from_user.id
-    prompt = get_system_prompt(user_id)
-    await bot.reply_to(message, f"{get_user_text(user_id, 'system_prompt_current')}\n{prompt}")
+    prompt = await get_system_prompt(user_id)
+    await outbox.reply_to(bot, message, f"{get_user_text(user_id, 'system_prompt_current')}\n{prompt}")
 
 # Safe message editing
 async def safe_edit_message(bot, text, chat_id, message_id, parse_mode=None):
@@ -196,366 +507,468 @@ async def safe_edit_message(bot, text, chat_id, message_id, parse_mode=None):
         kwargs = {"text": text, "chat_id": chat_id, "message_id": message_id}
         if parse_mode:
             kwargs["parse_mode"] = parse_mode
-        await bot.edit_message_text(**kwargs)
+        await outbox.edit_message_text(bot, **kwargs)
     except Exception as e:
         if "message is not modified" not in str(e).lower():
             print(f"Error editing message: {e}")
 
-async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
+async def send_markdown_message(bot, chat_id, text, raw_text):
+    """Send an escaped MarkdownV2 message, falling back to the raw text if Telegram rejects it"""
+    try:
+        return await outbox.send_message(bot, chat_id, text or raw_text or "...", parse_mode="MarkdownV2")
+    except Exception as e:
+        print(f"Error sending markdown message: {e}")
+        return await outbox.send_message(bot, chat_id, raw_text or "...")
+
+async def edit_page(bot, pager, sent_message, reply):
+    """Freeze any finished pages and return the message holding the current page; new messages are added to reply.pages"""
+    pages = pager.pop_pages()
+    if not pages:
+        return sent_message, False
+    page, raw_page = pages[0]
+    await safe_edit_message(bot, page, sent_message.chat.id, sent_message.message_id, "MarkdownV2")
+    for page, raw_page in pages[1:]:
+        sent_message = await send_markdown_message(bot, sent_message.chat.id, page, raw_page)
+        reply.pages.append(sent_message)
+    sent_message = await send_markdown_message(bot, sent_message.chat.id, pager.render(), pager.page_text)
+    reply.pages.append(sent_message)
+    return sent_message, True
+
+def observe_response(model, started, response, slot):
+    """Record the latency and token usage of a complete (non-streamed) response from slot's key"""
+    usage_metadata = getattr(response, "usage_metadata", None)
+    metrics.generation_seconds.observe(time.perf_counter() - started, model)
+    metrics.record_usage(model, usage_metadata)
+    record_key_usage(slot, model, usage_metadata)
+
+def request_tokens(chat_dict, user_id, parts):
+    """Rough prompt tokens of sending parts on the user's chat, for picking a key with quota left"""
+    chat = chat_dict.get(user_id)
+    history = chat.get_history() if chat is not None else []
+    return estimate_tokens([*history, types.Content(role="user", parts=parts)])
+
+async def edit_reply(bot, reply, text):
+    """Show text in a PendingReply: instead of its text while it is queued, by editing it once it is sent"""
+    if reply.replace(text):
+        return
+    sent_message = await reply.sent()
+    await safe_edit_message(bot, text, sent_message.chat.id, sent_message.message_id)
+
+async def stream_to_message(bot, response_stream, reply, model=None, started=None, slot=None):
+    """Stream a Gemini response into a PendingReply and return the full answer text.
+
+    If the reply is still queued when the first words arrive, it goes out with
+    them instead of its placeholder text. Answers longer than one Telegram
+    message continue in new messages; only the last page is edited while
+    streaming. With model and started (perf_counter when the request was
+    sent), the response's latency and tokens are recorded, and with slot its
+    tokens count against that key's quota.
+    """
+    pager = StreamPager(conf["message_page_limit"])
+    last_update = time.time()
+    update_interval = conf["streaming_update_interval"]
+    first_chunk = True
+    usage_metadata = None
     sent_message = None
+    async for chunk in response_stream:
+        if first_chunk and model is not None:
+            metrics.time_to_first_token_seconds.observe(time.perf_counter() - started, model)
+            first_chunk = False
+        # Only the last chunk carries the totals for the whole response
+        usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+        if hasattr(chunk, 'text') and chunk.text:
+            pager.feed(chunk.text)
+            if sent_message is None:
+                # The first words are shown at once, in the reply itself if it is still queued
+                if reply.replace(pager.page_text):
+                    sent_message = await reply.sent()
+                    last_update = time.time()
+                    continue
+                sent_message = await reply.sent()
+                last_update = 0.0
+            current_time = time.time()
+            if current_time - last_update >= update_interval:
+                sent_message, paged = await edit_page(bot, pager, sent_message, reply)
+                if not paged:
+                    # Not awaited: the outbox sends it when the chat's rate budget allows,
+                    # or drops it in favour of a newer edit of the same page.
+                    outbox.edit_message_text_nowait(bot, pager.render(), sent_message.chat.id, sent_message.message_id, parse_mode="MarkdownV2")
+                last_update = current_time
+    if sent_message is None:
+        sent_message = await reply.sent()
+    sent_message, _ = await edit_page(bot, pager, sent_message, reply)
     try:
-        if client is None:
-            await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty"))
+        await safe_edit_message(bot, pager.render(), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
+    except Exception:
+        await safe_edit_message(bot, pager.page_text, sent_message.chat.id, sent_message.message_id)
+    if model is not None:
+        metrics.generation_seconds.observe(time.perf_counter() - started, model)
+        metrics.record_usage(model, usage_metadata)
+        if slot is not None:
+            record_key_usage(slot, model, usage_metadata)
+    return pager.text
+
+async def delete_pages(bot, reply):
+    """Delete the pages an answer cut off mid-way continued in after reply, before it starts over in reply"""
+    pages, reply.pages = reply.pages, []
+    for page in pages:
+        try:
+            await outbox.delete_message(bot, chat_id=page.chat.id, message_id=page.message_id)
+        except Exception as e:
+            print(f"Error deleting page of an interrupted answer: {e}")
+
+def retry_notifier(bot, message, reply):
+    """on_retry callback for retry_executor that tells the user in reply why the answer is late"""
+    async def on_retry(error, kind, delay):
+        await delete_pages(bot, reply)
+        text_key = "api_quota_exhausted" if kind == QUOTA else "retrying"
+        await edit_reply(bot, reply, get_user_text(message.from_user.id, text_key))
+    return on_retry
+
+async def admit(bot, message, reply, model, priority):
+    """Wait for room to call model, showing the queue position in reply; False if the request was shed"""
+    async def show_position(position):
+        await edit_reply(bot, reply, f"{get_user_text(message.from_user.id, 'queue_position')} {position}")
+    try:
+        await admission.acquire(model, priority, show_position, conf["queue_position_interval"])
+    except Shed:
+        await edit_reply(bot, reply, get_user_text(message.from_user.id, "overloaded"))
+        return False
+    return True
+
+async def open_stream(request):
+    """Await request (returning a chunk stream) and the first chunk; returns (first chunk or None, chunk iterator).
+
+    Raises asyncio.TimeoutError, which is retried as a deadline, if the first
+    chunk takes longer than gemini_first_chunk_timeout.
+    """
+    async def first_chunk():
+        iterator = (await request).__aiter__()
+        try:
+            return await iterator.__anext__(), iterator
+        except StopAsyncIteration:
+            return None, iterator
+    return await asyncio.wait_for(first_chunk(), conf["gemini_first_chunk_timeout"])
+
+async def chain_stream(first, iterator):
+    """The chunks of a stream opened by open_stream(); a gap over gemini_stream_idle_timeout raises asyncio.TimeoutError"""
+    if first is None:
+        return
+    yield first
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), conf["gemini_stream_idle_timeout"])
+        except StopAsyncIteration:
             return
-        sent_message = await bot.reply_to(message, "🤖 Generating answers...")
-        chat_dict = gemini_chat_dict if model_type == model_1 else gemini_pro_chat_dict
-        if str(message.from_user.id) not in chat_dict:
-            system_prompt = get_system_prompt(message.from_user.id)
-            try:
-                chat = client.aio.chats.create(
-                    model=model_type,
-                    config=types.GenerateContentConfig(system_instruction=system_prompt, tools=[search_tool])
-                )
-                chat_dict[str(message.from_user.id)] = chat
-            except Exception as e:
-                print(f"Failed to set system prompt in chat creation: {e}")
-                chat = client.aio.chats.create(
-                    model=model_type, 
-                    config=types.GenerateContentConfig(tools=[search_tool])
-                )
-                chat_dict[str(message.from_user.id)] = chat
-        else:
-            chat = chat_dict[str(message.from_user.id)]
+        yield chunk
 
-        max_retry_attempts = len(api_keys)
-        retry_count = 0
-        while retry_count < max_retry_attempts:
-            try:
-                response = await chat.send_message_stream(m)
-                full_response = ""
-                last_update = time.time()
-                update_interval = conf["streaming_update_interval"]
-                async for chunk in response:
-                    if hasattr(chunk, 'text') and chunk.text:
-                        full_response += chunk.text
-                        current_time = time.time()
-                        if current_time - last_update >= update_interval:
-                            try:
-                                await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                            except Exception as e:
-                                if "parse markdown" in str(e).lower():
-                                    await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                                elif "message is not modified" not in str(e).lower():
-                                    print(f"Error updating message: {e}")
-                            last_update = current_time
-                try:
-                    await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                except Exception as e:
-                    if "parse markdown" in str(e).lower():
-                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                break
-            except Exception as e:
-                error_str = str(e)
-                if (hasattr(e, 'status_code') and e.status_code == 429) or ("429 RESOURCE_EXHAUSTED" in error_str and "You exceeded your current quota" in error_str):
-                    if switch_to_next_api_key():
-                        try:
-                            await safe_edit_message(bot, get_user_text(message.from_user.id, "api_quota_exhausted"), sent_message.chat.id, sent_message.message_id)
-                        except Exception: pass
-                        system_prompt = get_system_prompt(message.from_user.id)
-                        chat = client.aio.chats.create(model=model_type, config=types.GenerateContentConfig(system_instruction=system_prompt, tools=[search_tool]))
-                        chat_dict[str(message.from_user.id)] = chat
-                        retry_count += 1
-                        continue
-                    else:
-                        await safe_edit_message(bot, f"{error_info}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}", sent_message.chat.id, sent_message.message_id)
-                        break
+async def discard_stream(task, slot):
+    """Cancel a request that lost the race and give its key back"""
+    task.cancel()
+    try:
+        _, iterator = await task
+        await iterator.aclose()
+    except BaseException:
+        pass
+    current_tenant.get().key_pool.release(slot, "cancelled")
+
+async def send_hedged(chat, model_name, user_id, slot, message, tried_slots):
+    """Send message on chat with slot's key; returns (stream, slot) of the request that answers first.
+
+    If no chunk has arrived after the hedge threshold, the same turn is also
+    sent with another key. The loser is cancelled, which leaves the history
+    untouched, and its key released; the caller releases the returned slot as
+    usual. If both fail, the first request's error is raised.
+    """
+    started = time.perf_counter()
+    config = await chat_config(slot, model_name, user_id)
+    primary = asyncio.create_task(open_stream(chat.send_message_stream(slot.client, model_name, message, config)))
+    threshold = hedge_policy.threshold(model_name)
+    hedge_slot = None
+    if threshold is not None:
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        # Checked and recorded without a pause in between, so concurrent requests cannot all pass
+        if not done and hedge_policy.allow():
+            hedge_slot = current_tenant.get().key_pool.acquire(tried_slots, model_name)
+    hedge_policy.record_request(hedge_slot is not None)
+    if hedge_slot is None:
+        first, iterator = await primary
+        hedge_policy.record_ttft(model_name, time.perf_counter() - started)
+        return chain_stream(first, iterator), slot
+
+    tried_slots.add(hedge_slot)
+    # Inline system prompt: a cached one belongs to the first key
+    config = types.GenerateContentConfig(system_instruction=await get_system_prompt(user_id), tools=[search_tool])
+    hedge = asyncio.create_task(open_stream(chat.send_message_stream(hedge_slot.client, model_name, message, config)))
+    contenders = {primary: (slot, "primary"), hedge: (hedge_slot, "hedge")}
+    pending = {primary, hedge}
+    failed = {}  # task -> its exception
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in (primary, hedge):
+            if task not in done:
+                continue
+            if task.exception() is not None:
+                failed[task] = task.exception()
+                continue
+            winner_slot, winner = contenders[task]
+            for other, (other_slot, _) in contenders.items():
+                if other is task:
+                    continue
+                if other in failed:
+                    release_failed(other_slot, failed[other])
                 else:
-                    await safe_edit_message(bot, f"{error_info}\nError details: {str(e)}", sent_message.chat.id, sent_message.message_id)
-                    break
-            retry_count += 1
+                    await discard_stream(other, other_slot)
+            first, iterator = task.result()
+            hedge_policy.record_ttft(model_name, time.perf_counter() - started)
+            metrics.hedges_total.inc(model_name, winner)
+            return chain_stream(first, iterator), winner_slot
+    # Both failed: the hedge's key is released here, the first key by the caller
+    release_failed(hedge_slot, failed[hedge])
+    metrics.hedges_total.inc(model_name, "none")
+    raise failed[primary]
+
+async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
+    reply = None
+    tenant = current_tenant.get()
+    try:
+        if not tenant.api_keys:
+            await outbox.reply_to(bot, message, get_user_text(message.from_user.id, "api_key_list_empty"))
+            return
+        # Not awaited: the placeholder is sent while the request is under way
+        reply = outbox.PendingReply(bot, message, "🤖 Generating answers...")
+        chat_dict = tenant.gemini_chat_dict if model_type == tenant.model_1 else tenant.gemini_pro_chat_dict
+        user_id = str(message.from_user.id)
+
+        async def turn(attempt):
+            chat = await get_chat(chat_dict, user_id, model_type)
+            started = time.perf_counter()
+            response, attempt.slot = await send_hedged(chat, model_type, user_id, attempt.slot, m, attempt.tried)
+            answer = await stream_to_message(bot, response, reply, model_type, started, attempt.slot)
+            return chat, answer
+
+        if not await admit(bot, message, reply, model_type, PRIORITY_CHAT):
+            return
+        try:
+            tokens = request_tokens(chat_dict, user_id, [types.Part.from_text(text=m)])
+            chat, answer = await tenant.retry_executor.run(turn, model_type, tokens, on_retry=retry_notifier(bot, message, reply))
+        except NoKeyAvailable:
+            await edit_reply(bot, reply, f"{error_info}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}")
+            return
+        finally:
+            admission.release(model_type)
+        chat_dict.update_size(user_id)
+        await record_turn(user_id, model_type, [types.Part.from_text(text=m)], answer)
+        schedule_compaction(user_id, model_type, chat)
     except Exception as e:
-        if sent_message:
-            await safe_edit_message(bot, f"{error_info}\nError details: {str(e)}", sent_message.chat.id, sent_message.message_id)
+        if reply:
+            await edit_reply(bot, reply, f"{error_info}\nError details: {str(e)}")
         else:
-            await bot.reply_to(message, f"{error_info}\nError details: {str(e)}")
+            await outbox.reply_to(bot, message, f"{error_info}\nError details: {str(e)}")
+
+async def prepare_image_parts(photo_files, photo_ids=None):
+    """Downscale and encode the photos concurrently into JPEG parts"""
+    photo_ids = photo_ids or [None] * len(photo_files)
+    images = await asyncio.gather(*(preprocess_image(data, photo_id) for data, photo_id in zip(photo_files, photo_ids)))
+    return [types.Part.from_bytes(data=image, mime_type="image/jpeg") for image in images]
+
+async def generate_image(slot, contents):
+    """One image generation request on slot's key"""
+    model_3 = current_tenant.get().model_3
+    started = time.perf_counter()
+    response = await slot.client.aio.models.generate_content(
+        model=model_3,
+        contents=contents,
+        config=types.GenerateContentConfig(**draw_generation_config)
+    )
+    observe_response(model_3, started, response, slot)
+    return response
 
-async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes):
-    if client is None:
-        await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty"))
+async def gemini_edit(bot: TeleBot, message: Message, m: str, download):
+    """Edit the photos returned by await download() (files, ids) as m asks; they download while the placeholder is sent"""
+    tenant = current_tenant.get()
+    model_3 = tenant.model_3
+    if not tenant.api_keys:
+        await outbox.reply_to(bot, message, get_user_text(message.from_user.id, "api_key_list_empty"))
         return
-    sent_message = await bot.reply_to(message, download_pic_notify)
-    max_retry_attempts = len(api_keys)
-    retry_count = 0
-    while retry_count < max_retry_attempts:
-        try:
-            try:
-                image = Image.open(io.BytesIO(photo_file))
-                buffer = io.BytesIO()
-                image.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-            except Exception as img_error:
-                await safe_edit_message(bot, f"{error_info}\nImage processing error: {str(img_error)}", sent_message.chat.id, sent_message.message_id)
-                return
-            
-            text_part = types.Part.from_text(text=m)
-            image_part = types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
-            
-            response = await client.aio.models.generate_content(
-                model=model_3,
-                contents=[text_part, image_part],
-                config=types.GenerateContentConfig(**draw_generation_config)
-            )
-            
-            if not hasattr(response, 'candidates') or not response.candidates:
-                await safe_edit_message(bot, f"{error_info}\nNo candidates generated", sent_message.chat.id, sent_message.message_id)
-                return
-            
-            text = ""
-            img = None
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'content') and candidate.content:
-                for part in candidate.content.parts:
-                    if hasattr(part, 'text') and part.text:
-                        text += part.text
-                    if hasattr(part, 'inline_data') and part.inline_data:
-                        img = part.inline_data.data
-            
-            if img:
-                with io.BytesIO(img) as bio:
-                    await bot.send_photo(message.chat.id, bio)
-            if text:
-                if len(text) > 4000:
-                    await bot.send_message(message.chat.id, escape(text[:4000]), parse_mode="MarkdownV2")
-                    await bot.send_message(message.chat.id, escape(text[4000:]), parse_mode="MarkdownV2")
-                else:
-                    await bot.send_message(message.chat.id, escape(text), parse_mode="MarkdownV2")
-            
-            await bot.delete_message(chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-            break
-            
-        except Exception as e:
-            error_str = str(e)
-            if (hasattr(e, 'status_code') and e.status_code == 429) or ("429 RESOURCE_EXHAUSTED" in error_str and "You exceeded your current quota" in error_str):
-                if switch_to_next_api_key():
-                    try:
-                        await safe_edit_message(bot, get_user_text(message.from_user.id, "api_quota_exhausted"), sent_message.chat.id, sent_message.message_id)
-                    except Exception: pass
-                    retry_count += 1
-                    continue
-                else:
-                    await safe_edit_message(bot, f"{error_info}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}", sent_message.chat.id, sent_message.message_id)
-                    break
-            else:
-                await safe_edit_message(bot, f"{error_info}\nError details: {str(e)}", sent_message.chat.id, sent_message.message_id)
-                break
-        retry_count += 1
-
-async def gemini_image_understand(bot: TeleBot, message: Message, photo_file: bytes, prompt: str = ""):
-    sent_message = None
+    reply = outbox.PendingReply(bot, message, download_pic_notify)
+    try:
+        photo_files, photo_ids = await download()
+        image_parts = await prepare_image_parts(photo_files, photo_ids)
+    except Exception as img_error:
+        await edit_reply(bot, reply, f"{error_info}\nImage processing error: {str(img_error)}")
+        return
+    text_part = types.Part.from_text(text=m)
+
+    if not await admit(bot, message, reply, model_3, PRIORITY_IMAGE):
+        return
+    try:
+        response = await tenant.retry_executor.run(
+            lambda attempt: generate_image(attempt.slot, [text_part, *image_parts]),
+            model_3,
+            estimate_tokens([types.Content(role="user", parts=[text_part, *image_parts])]),
+            timeout=conf["gemini_request_timeout"],
+            on_retry=retry_notifier(bot, message, reply),
+        )
+    except NoKeyAvailable:
+        await edit_reply(bot, reply, f"{error_info}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}")
+        return
+    except Exception as e:
+        await edit_reply(bot, reply, f"{error_info}\nError details: {str(e)}")
+        return
+    finally:
+        admission.release(model_3)
+
+    try:
+        if not hasattr(response, 'candidates') or not response.candidates:
+            await edit_reply(bot, reply, f"{error_info}\nNo candidates generated")
+            return
+        
+        text = ""
+        img = None
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'content') and candidate.content:
+            for part in candidate.content.parts:
+                if hasattr(part, 'text') and part.text:
+                    text += part.text
+                if hasattr(part, 'inline_data') and part.inline_data:
+                    img = part.inline_data.data
+        
+        if img:
+            with io.BytesIO(img) as bio:
+                await outbox.send_photo(bot, message.chat.id, bio)
+        if text:
+            for page, raw_page in paginate(text, conf["message_page_limit"]):
+                await send_markdown_message(bot, message.chat.id, page, raw_page)
+        
+        sent_message = await reply.sent()
+        await outbox.delete_message(bot, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
+    except Exception as e:
+        await edit_reply(bot, reply, f"{error_info}\nError details: {str(e)}")
+
+async def gemini_image_understand(bot: TeleBot, message: Message, download, prompt: str = ""):
+    """Answer prompt about the photos returned by await download() (files, ids); they download while the placeholder is sent"""
+    reply = None
+    tenant = current_tenant.get()
     try:
-        if client is None:
-            await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty"))
+        if not tenant.api_keys:
+            await outbox.reply_to(bot, message, get_user_text(message.from_user.id, "api_key_list_empty"))
             return
             
-        sent_message = await bot.reply_to(message, download_pic_notify)
+        reply = outbox.PendingReply(bot, message, download_pic_notify)
+        photo_files, photo_ids = await download()
 
         if not prompt:
-            prompt = "Describe this image"
+            prompt = "Describe this image" if len(photo_files) == 1 else "Describe these images"
 
-        max_retry_attempts = len(api_keys)
-        retry_count = 0
-        while retry_count < max_retry_attempts:
+        image_parts = await prepare_image_parts(photo_files, photo_ids)
+        text_part = types.Part.from_text(text=prompt)
+
+        user_id = str(message.from_user.id)
+        is_model_1_default = tenant.default_model_dict.get(user_id, True)
+        active_chat_dict = tenant.gemini_chat_dict if is_model_1_default else tenant.gemini_pro_chat_dict
+        current_model_name = tenant.model_1 if is_model_1_default else tenant.model_2
+        system_prompt = await get_system_prompt(message.from_user.id)
+
+        async def turn(attempt):
+            chat = await get_chat(active_chat_dict, user_id, current_model_name)
             try:
-                user_id = str(message.from_user.id)
-                is_model_1_default = default_model_dict.get(user_id, True)
-                active_chat_dict = gemini_chat_dict if is_model_1_default else gemini_pro_chat_dict
-                current_model_name = model_1 if is_model_1_default else model_2
-                
-                image_obj = Image.open(io.BytesIO(photo_file))
-                buffer = io.BytesIO()
-                image_obj.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-
-                system_prompt = get_system_prompt(message.from_user.id)
-                image_part = types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
-                text_part = types.Part.from_text(text=prompt)
-                
-                if user_id not in active_chat_dict:
-                    try:
-                        chat = client.aio.chats.create(
-                            model=current_model_name,
-                            config=types.GenerateContentConfig(system_instruction=system_prompt, tools=[search_tool])
-                        )
-                        active_chat_dict[user_id] = chat
-                    except Exception as e:
-                        print(f"Failed to create chat with system prompt: {e}")
-                        chat = client.aio.chats.create(
-                            model=current_model_name,
-                            config=types.GenerateContentConfig(tools=[search_tool])
-                        )
-                        active_chat_dict[user_id] = chat
-                else:
-                    chat = active_chat_dict[user_id]
-                
-                try:
-                    parts = [text_part, image_part]
-                    response_stream = await chat.send_message_stream(parts)
-                    full_response = ""
-                    last_update = time.time()
-                    update_interval = conf["streaming_update_interval"]
-                    async for chunk in response_stream:
-                        if hasattr(chunk, 'text') and chunk.text:
-                            full_response += chunk.text
-                            current_time = time.time()
-                            if current_time - last_update >= update_interval:
-                                try:
-                                    await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                                except Exception as e_stream:
-                                    if "parse markdown" in str(e_stream).lower():
-                                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                                    elif "message is not modified" not in str(e_stream).lower():
-                                        print(f"Image understanding stream update error: {e_stream}")
-                                last_update = current_time
-                    try:
-                        await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                    except Exception:
-                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                    break
-                except Exception as chat_error:
-                    print(f"Sending image via chat session failed: {chat_error}. Falling back to direct model call.")
-                    response_stream = await client.aio.models.generate_content_stream(
-                        model=current_model_name,
-                        contents=[text_part, image_part],
-                        config=types.GenerateContentConfig(system_instruction=system_prompt, **generation_config)
-                    )
-                    full_response = ""
-                    last_update = time.time()
-                    update_interval = conf["streaming_update_interval"]
-                    async for chunk in response_stream:
-                        if hasattr(chunk, 'text') and chunk.text:
-                            full_response += chunk.text
-                            current_time = time.time()
-                            if current_time - last_update >= update_interval:
-                                try:
-                                    await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                                except Exception as e_stream:
-                                    if "parse markdown" in str(e_stream).lower():
-                                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                                    elif "message is not modified" not in str(e_stream).lower():
-                                        print(f"Image understanding stream update error: {e_stream}")
-                                last_update = current_time
-                    try:
-                        await safe_edit_message(bot, escape(full_response), sent_message.chat.id, sent_message.message_id, "MarkdownV2")
-                    except Exception:
-                        await safe_edit_message(bot, full_response, sent_message.chat.id, sent_message.message_id)
-                    
-                    try:
-                        user_content = types.Content.from_parts([text_part, image_part], role="user")
-                        model_content = types.Content.from_parts([types.Part.from_text(full_response)], role="model")
-                        if not hasattr(chat, 'history'):
-                            chat.history = []
-                        chat.history.append(user_content)
-                        chat.history.append(model_content)
-                    except Exception as history_error:
-                        print(f"Failed to manually update chat history: {history_error}")
-                    break
-            except Exception as e:
-                error_str = str(e)
-                if (hasattr(e, 'status_code') and e.status_code == 429) or ("429 RESOURCE_EXHAUSTED" in error_str and "You exceeded your current quota" in error_str):
-                    if switch_to_next_api_key():
-                        try:
-                            await safe_edit_message(bot, get_user_text(message.from_user.id, "api_quota_exhausted"), sent_message.chat.id, sent_message.message_id)
-                        except Exception: pass
-                        retry_count += 1
-                        continue
-                    else:
-                        await safe_edit_message(bot, f"{error_info}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}", sent_message.chat.id, sent_message.message_id)
-                        break
-                else:
-                    error_message = f"{get_user_text(message.from_user.id, 'error_info')}\nError details: {error_str}"
-                    if sent_message:
-                        await safe_edit_message(bot, error_message, sent_message.chat.id, sent_message.message_id)
-                    else:
-                        await bot.reply_to(message, error_message)
-                    break
-            retry_count += 1
+                parts = [text_part, *image_parts]
+                started = time.perf_counter()
+                response_stream, attempt.slot = await send_hedged(chat, current_model_name, user_id, attempt.slot, parts, attempt.tried)
+                full_response = await stream_to_message(bot, response_stream, reply, current_model_name, started, attempt.slot)
+            except Exception as chat_error:
+                if classify(chat_error) != PERMANENT:
+                    raise
+                print(f"Sending image with the chat history failed: {chat_error}. Falling back to sending it alone.")
+                await delete_pages(bot, reply)
+                started = time.perf_counter()
+                response_stream = chain_stream(*await open_stream(attempt.slot.client.aio.models.generate_content_stream(
+                    model=current_model_name,
+                    contents=[text_part, *image_parts],
+                    config=types.GenerateContentConfig(system_instruction=system_prompt, **generation_config)
+                )))
+                full_response = await stream_to_message(bot, response_stream, reply, current_model_name, started, attempt.slot)
+                chat.append(user_content([text_part, *image_parts]), types.Content(role="model", parts=[types.Part.from_text(text=full_response)]))
+            return chat, full_response
+
+        if not await admit(bot, message, reply, current_model_name, PRIORITY_VISION):
+            return
+        try:
+            tokens = request_tokens(active_chat_dict, user_id, [text_part, *image_parts])
+            chat, full_response = await tenant.retry_executor.run(turn, current_model_name, tokens, on_retry=retry_notifier(bot, message, reply))
+        except NoKeyAvailable:
+            await edit_reply(bot, reply, f"{error_info}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}")
+            return
+        finally:
+            admission.release(current_model_name)
+        active_chat_dict.update_size(user_id)
+        await record_turn(user_id, current_model_name, [text_part, *image_parts], full_response)
+        schedule_compaction(user_id, current_model_name, chat)
     except Exception as e:
-        if sent_message:
-            await safe_edit_message(bot, f"{error_info}\nError details: {str(e)}", sent_message.chat.id, sent_message.message_id)
+        if reply:
+            await edit_reply(bot, reply, f"{error_info}\nError details: {str(e)}")
         else:
-            await bot.reply_to(message, f"{error_info}\nError details: {str(e)}")
+            await outbox.reply_to(bot, message, f"{error_info}\nError details: {str(e)}")
 
 async def gemini_draw(bot:TeleBot, message:Message, m:str):
-    sent_message = None
+    reply = None
+    tenant = current_tenant.get()
+    model_3 = tenant.model_3
     try:
-        if client is None:
-            await bot.reply_to(message, get_user_text(message.from_user.id, "api_key_list_empty"))
+        if not tenant.api_keys:
+            await outbox.reply_to(bot, message, get_user_text(message.from_user.id, "api_key_list_empty"))
             return
             
-        sent_message = await bot.reply_to(message, get_user_text(message.from_user.id, "drawing_message"))
+        reply = outbox.PendingReply(bot, message, get_user_text(message.from_user.id, "drawing_message"))
             
-        max_retry_attempts = len(api_keys)
-        retry_count = 0
-        while retry_count < max_retry_attempts:
-            try:
-                response = await client.aio.models.generate_content(
-                    model=model_3,
-                    contents=m,
-                    config=types.GenerateContentConfig(**draw_generation_config)
-                )
-                
-                if not hasattr(response, 'candidates') or not response.candidates:
-                    error_msg = get_user_text(message.from_user.id, "error_info")
-                    await safe_edit_message(bot, f"{error_msg}\nNo candidates generated", sent_message.chat.id, sent_message.message_id)
-                    break
-                
-                text = ""
-                img = None
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'content') and candidate.content:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            text += part.text
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            img = part.inline_data.data
-                
-                if img:
-                    with io.BytesIO(img) as bio:
-                        await bot.send_photo(message.chat.id, bio)
-                if text:
-                    if len(text) > 4000:
-                        await bot.send_message(message.chat.id, escape(text[:4000]), parse_mode="MarkdownV2")
-                        await bot.send_message(message.chat.id, escape(text[4000:]), parse_mode="MarkdownV2")
-                    else:
-                        await bot.send_message(message.chat.id, escape(text), parse_mode="MarkdownV2")
-                
-                try:
-                    await bot.delete_message(chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-                except Exception: pass
-                break
-                
-            except Exception as e:
-                error_str = str(e)
-                if (hasattr(e, 'status_code') and e.status_code == 429) or ("429 RESOURCE_EXHAUSTED" in error_str and "You exceeded your current quota" in error_str):
-                    if switch_to_next_api_key():
-                        try:
-                            await safe_edit_message(bot, get_user_text(message.from_user.id, "api_quota_exhausted"), sent_message.chat.id, sent_message.message_id)
-                        except Exception: pass
-                        retry_count += 1
-                        continue
-                    else:
-                        error_msg = get_user_text(message.from_user.id, "error_info")
-                        await safe_edit_message(bot, f"{error_msg}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}", sent_message.chat.id, sent_message.message_id)
-                        break
-                else:
-                    error_msg = get_user_text(message.from_user.id, "error_info")
-                    await safe_edit_message(bot, f"{error_msg}\nError details: {str(e)}", sent_message.chat.id, sent_message.message_id)
-                    break
-            retry_count += 1
+        if not await admit(bot, message, reply, model_3, PRIORITY_IMAGE):
+            return
+        try:
+            response = await tenant.retry_executor.run(
+                lambda attempt: generate_image(attempt.slot, m),
+                model_3,
+                estimate_tokens([types.Content(role="user", parts=[types.Part.from_text(text=m)])]),
+                timeout=conf["gemini_request_timeout"],
+                on_retry=retry_notifier(bot, message, reply),
+            )
+        except NoKeyAvailable:
+            error_msg = get_user_text(message.from_user.id, "error_info")
+            await edit_reply(bot, reply, f"{error_msg}\n{get_user_text(message.from_user.id, 'all_api_quota_exhausted')}")
+            return
+        finally:
+            admission.release(model_3)
+
+        if not hasattr(response, 'candidates') or not response.candidates:
+            error_msg = get_user_text(message.from_user.id, "error_info")
+            await edit_reply(bot, reply, f"{error_msg}\nNo candidates generated")
+            return
+        
+        text = ""
+        img = None
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'content') and candidate.content:
+            for part in candidate.content.parts:
+                if hasattr(part, 'text') and part.text:
+                    text += part.text
+                if hasattr(part, 'inline_data') and part.inline_data:
+                    img = part.inline_data.data
+        
+        if img:
+            with io.BytesIO(img) as bio:
+                await outbox.send_photo(bot, message.chat.id, bio)
+        if text:
+            for page, raw_page in paginate(text, conf["message_page_limit"]):
+                await send_markdown_message(bot, message.chat.id, page, raw_page)
+        
+        try:
+            sent_message = await reply.sent()
+            await outbox.delete_message(bot, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
+        except Exception: pass
             
     except Exception as e:
         error_msg = get_user_text(message.from_user.id, "error_info")
-        if sent_message:
-            await safe_edit_message(bot, f"{error_msg}\nError details: {str(e)}", sent_message.chat.id, sent_message.message_id)
+        if reply:
+            await edit_reply(bot, reply, f"{error_msg}\nError details: {str(e)}")
         else:
-            await bot.reply_to(message, f"{error_msg}\nError details: {str(e)}")
+            await outbox.reply_to(bot, message, f"{error_msg}\nError details: {str(e)}")
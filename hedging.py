@@ -0,0 +1,47 @@
+from collections import deque
+
+
+class HedgePolicy:
+    """Decides when a slow streamed request gets a duplicate on another key.
+
+    The threshold is conf's fixed delay if one is set, otherwise the rolling
+    95th percentile of time-to-first-token for the model (never below
+    min_delay). At most max_ratio of the last window requests are hedged, and
+    until min_samples requests are recorded the ratio is taken of
+    min_samples, so not even a burst right after startup doubles the spend.
+    """
+
+    def __init__(self, enabled, delay, min_delay, max_ratio, window=200, min_samples=20):
+        self.enabled = enabled
+        self.delay = delay
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._ttft = {}                       # model -> recent time-to-first-token samples
+        self._recent = deque(maxlen=window)   # True for each recent request that was hedged
+
+    def record_ttft(self, model, seconds):
+        self._ttft.setdefault(model, deque(maxlen=self._recent.maxlen)).append(seconds)
+
+    def threshold(self, model):
+        """Seconds to wait for a first chunk before hedging, or None to never hedge"""
+        if not self.enabled:
+            return None
+        if self.delay is not None:
+            return self.delay
+        samples = self._ttft.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[int(0.95 * (len(ordered) - 1))])
+
+    def record_request(self, hedged):
+        self._recent.append(hedged)
+
+    def ratio(self):
+        """Share of the recent requests that were hedged"""
+        return sum(self._recent) / len(self._recent) if self._recent else 0.0
+
+    def allow(self):
+        """Whether hedging the current request keeps the hedges within max_ratio of the recent requests"""
+        return sum(self._recent) + 1 <= self.max_ratio * max(len(self._recent) + 1, self.min_samples)
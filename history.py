@@ -0,0 +1,87 @@
+from lazy import types
+
+# Rough Gemini accounting: ~4 characters per text token, a flat cost per image
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 258
+
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an assistant so it can replace the "
+    "original messages as context. Keep facts, names, numbers, decisions, the user's preferences and "
+    "any open questions. Be concise and write in the language of the conversation.\n\n"
+)
+SUMMARY_PREFIX = "Summary of our earlier conversation:\n"
+DROPPED_MARKER = "[Earlier messages were dropped to keep the conversation within its context budget.]"
+
+
+def estimate_tokens(contents):
+    """Approximate prompt tokens for a list of types.Content"""
+    tokens = 0
+    for content in contents:
+        for part in content.parts or []:
+            if part.text:
+                tokens += len(part.text) // CHARS_PER_TOKEN + 1
+            elif part.inline_data is not None:
+                tokens += IMAGE_TOKENS
+    return tokens
+
+
+def split_point(contents, keep_tokens):
+    """Index of the first content to keep verbatim.
+
+    Walks back from the newest turn keeping whole turns while they fit in
+    keep_tokens; the split always falls on the start of a user turn. The
+    newest turn is always kept.
+    """
+    split = len(contents)
+    kept = 0
+    for index in range(len(contents) - 1, -1, -1):
+        kept += estimate_tokens([contents[index]])
+        if contents[index].role != "user":
+            continue
+        if kept > keep_tokens and split < len(contents):
+            break
+        split = index
+    return split
+
+
+def transcript(contents):
+    """Render contents as plain text for the summarization prompt"""
+    lines = []
+    for content in contents:
+        speaker = "User" if content.role == "user" else "Assistant"
+        texts = []
+        for part in content.parts or []:
+            if part.text:
+                texts.append(part.text)
+            elif part.inline_data is not None:
+                texts.append("[image]")
+        if texts:
+            lines.append(f"{speaker}: {''.join(texts)}")
+    return "\n".join(lines)
+
+
+def _exchange(text):
+    return [
+        types.Content(role="user", parts=[types.Part.from_text(text=text)]),
+        types.Content(role="model", parts=[types.Part.from_text(text="Understood.")]),
+    ]
+
+
+def summary_contents(summary):
+    """History entries standing in for the summarized turns"""
+    return _exchange(SUMMARY_PREFIX + summary)
+
+
+def dropped_contents():
+    """History entries standing in for turns dropped without a summary"""
+    return _exchange(DROPPED_MARKER)
+
+
+def trim(contents, budget, keep_ratio):
+    """Drop the oldest turns, behind a marker, if contents are over budget"""
+    if estimate_tokens(contents) <= budget:
+        return contents
+    split = split_point(contents, int(budget * keep_ratio))
+    if split == 0:
+        return contents
+    return dropped_contents() + contents[split:]
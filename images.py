@@ -0,0 +1,53 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from lazy import Image
+from config import conf
+from filecache import photo_cache
+from metrics import image_encode_seconds
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Pillow releases the GIL while decoding and encoding, so a thread pool keeps
+# image work off the event loop without the cost of shipping bytes to processes.
+_executor = ThreadPoolExecutor(max_workers=conf["image_workers"], thread_name_prefix="image")
+
+
+def prepare_jpeg(data, max_edge, quality):
+    """Return data as a JPEG whose longest edge is at most max_edge.
+
+    JPEGs that are already small enough are passed through untouched.
+    """
+    image = Image.open(io.BytesIO(data))
+    if data.startswith(JPEG_MAGIC) and max(image.size) <= max_edge:
+        return data
+    if image.format == "JPEG":
+        # Let the decoder downscale by a power of two while reading; much cheaper than a full decode.
+        image.draft("RGB", (max_edge, max_edge))
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+async def preprocess_image(data, cache_key=None):
+    """Downscale and encode a photo for upload, in the image worker pool.
+
+    With a cache_key (the photo's file_unique_id) the result is cached, so
+    a repeated photo is encoded only once.
+    """
+    max_edge, quality = conf["image_max_edge"], conf["image_jpeg_quality"]
+    if cache_key is not None:
+        cache_key = f"{cache_key}.{max_edge}.{quality}.jpg"
+        cached = await photo_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    loop = asyncio.get_running_loop()
+    with image_encode_seconds.time():
+        image_bytes = await loop.run_in_executor(_executor, prepare_jpeg, data, max_edge, quality)
+    if cache_key is not None:
+        await photo_cache.put(cache_key, image_bytes)
+    return image_bytes
@@ -0,0 +1,131 @@
+import time
+from lazy import genai
+from metrics import key_switches_total, rate_limited_total
+
+
+class KeySlot:
+    """One API key, its client and its usage counters"""
+
+    def __init__(self, key):
+        self.key = key
+        self._client = None
+        self.in_flight = 0
+        self.success = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.cooldown_until = 0.0
+        self.label = f"...{key[-4:]}"  # safe to show in metrics
+
+    @property
+    def client(self):
+        """The key's genai.Client, created on first use so startup need not import google.genai"""
+        if self._client is None:
+            self._client = genai.Client(api_key=self.key)
+        return self._client
+
+    @property
+    def requests(self):
+        return self.success + self.rate_limited + self.errors
+
+    def cooldown_left(self, now=None):
+        """Seconds until the key may be used again (0 if it is healthy)"""
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.cooldown_until - now)
+
+
+class KeyPool:
+    """All configured API keys, each with its own client.
+
+    Requests go to the healthy key with the fewest requests in flight. A key
+    that answers 429 is put into a cooldown instead of moving every user to
+    the next key. With a QuotaTracker, keys whose local rate-limit budget for
+    the model is used up are skipped before they can answer 429.
+    """
+
+    def __init__(self, cooldown, quota=None):
+        self.cooldown = cooldown
+        self.quota = quota
+        self.slots = []
+        self.keys = []       # kept in step with slots, in the same order
+        self.preferred = 0   # index picked with /api_switch, wins ties
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, key):
+        """Create a client for key and add it to the pool"""
+        slot = KeySlot(key)
+        self.slots.append(slot)
+        self.keys.append(key)
+        return slot
+
+    def remove(self, key):
+        index = self.keys.index(key)
+        if self.quota is not None:
+            self.quota.forget_key(key)
+        del self.slots[index]
+        del self.keys[index]
+        if index < self.preferred or self.preferred >= len(self.slots):
+            self.preferred = max(0, self.preferred - 1)
+
+    def wait(self, slot, model=None, tokens=0, now=None):
+        """Seconds until slot can take a request of about tokens prompt tokens to model"""
+        wait = slot.cooldown_left(now)
+        if self.quota is not None and model is not None:
+            wait = max(wait, self.quota.wait(slot.key, model, tokens))
+        return wait
+
+    def acquire(self, exclude=(), model=None, tokens=0):
+        """Pick the least-loaded healthy key not in exclude with quota left for model, or None if there is none"""
+        now = time.monotonic()
+        best = None
+        best_rank = None
+        for index, slot in enumerate(self.slots):
+            if slot in exclude or self.wait(slot, model, tokens, now):
+                continue
+            rank = (slot.in_flight, index != self.preferred, slot.requests)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = slot, rank
+        if best is not None:
+            best.in_flight += 1
+            if self.quota is not None and model is not None:
+                self.quota.record_request(best.key, model)
+            if exclude:
+                key_switches_total.inc()
+        return best
+
+    def release(self, slot, outcome="ok", retry_after=None):
+        """Return a key acquired with acquire(); outcome is "ok", "rate_limited", "error" or "cancelled".
+
+        A rate-limited key cools down for retry_after seconds if the server
+        said how long to wait, otherwise for the pool's cooldown.
+        """
+        slot.in_flight -= 1
+        if outcome == "ok":
+            slot.success += 1
+        elif outcome == "rate_limited":
+            slot.rate_limited += 1
+            rate_limited_total.inc(slot.label)
+            cooldown = self.cooldown if retry_after is None else retry_after
+            slot.cooldown_until = time.monotonic() + cooldown
+            print(f"API key #{self._index(slot)} hit its quota, cooling down for {cooldown:g}s")
+        elif outcome != "cancelled":
+            slot.errors += 1
+
+    def next_ready(self, model=None, tokens=0):
+        """Seconds until some key can take a request to model (0 if one can now), or None without keys"""
+        if not self.slots:
+            return None
+        now = time.monotonic()
+        return min(self.wait(slot, model, tokens, now) for slot in self.slots)
+
+    def record_usage(self, slot, model, usage_metadata):
+        """Count the prompt tokens of a response towards slot's per-minute token budget"""
+        if self.quota is not None and usage_metadata is not None:
+            self.quota.record_tokens(slot.key, model, getattr(usage_metadata, "prompt_token_count", None) or 0)
+
+    def reset_cooldown(self, index):
+        self.slots[index].cooldown_until = 0.0
+
+    def _index(self, slot):
+        return self.slots.index(slot) if slot in self.slots else "?"
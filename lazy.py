@@ -0,0 +1,37 @@
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module that is only imported when first used.
+
+    google.genai.types alone takes most of a second to import, so the heavy
+    libraries are loaded after the bot has started polling (see preload())
+    or by the first request that needs them, whichever comes first.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+Image = LazyModule("PIL.Image")
+
+
+def preload():
+    """Import every lazy module now, e.g. in a thread once the bot is up"""
+    for module in (types, genai, Image):
+        module.load()
@@ -1,4 +1,9 @@
+import time
+STARTED = time.perf_counter()
+
 import asyncio
+import hashlib
+import json
 import os
 import sys
 import telebot
@@ -9,54 +14,106 @@ load_dotenv()
 
 import handlers
 import gemini
+import webhook
+import shards
+import updatelog
+import metrics
+import lazy
 from config import conf
 
+IMPORTED = time.perf_counter()
+MEASURE_STARTUP = "--measure-startup" in sys.argv  # report startup time and exit instead of running
+
 TG_TOKEN = os.getenv("TG_TOKEN")
 GOOGLE_GEMINI_KEY = os.getenv("GOOGLE_GEMINI_KEY")
 OWNER_ID = os.getenv("OWNER_ID")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public https URL; enables webhook mode instead of polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+METRICS_PORT = os.getenv("METRICS_PORT")  # Serves Prometheus metrics at /metrics when set
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+STATE_FILE = os.getenv("STATE_FILE", conf["state_file"])
+WORKERS = int(os.getenv("WORKERS") or 1)  # Worker processes; above 1, users are sharded across them (see shards.py)
+SHARD_INDEX = os.getenv("SHARD_INDEX")  # Set by the supervisor in each worker process
+SUPERVISOR = WORKERS > 1 and SHARD_INDEX is None and not MEASURE_STARTUP
+BOTS_FILE = os.getenv("BOTS_FILE")  # JSON list of bots to serve from this process instead of TG_TOKEN's
+
+def load_bots(path):
+    """Read the bot configurations in path, filling in the defaults"""
+    with open(path) as f:
+        bots = json.load(f)
+    for bot in bots:
+        if not bot.get("token"):
+            raise ValueError(f"a bot in {path} has no token")
+        bot.setdefault("name", bot["token"].split(":", 1)[0])
+        if isinstance(bot.get("keys"), str):
+            bot["keys"] = [key.strip() for key in bot["keys"].split(',') if key.strip()]
+        bot.setdefault("conversation_db", f"conversations-{bot['name']}.db")
+    return bots
+
+BOTS = load_bots(BOTS_FILE) if BOTS_FILE else None
 
-if not TG_TOKEN or not GOOGLE_GEMINI_KEY or not OWNER_ID:
+if BOTS is None and (not TG_TOKEN or not GOOGLE_GEMINI_KEY or not OWNER_ID):
     print("Error: Environment variables TG_TOKEN, GOOGLE_GEMINI_KEY, and OWNER_ID must be set.")
     sys.exit(1)
+if BOTS is not None and (WORKERS > 1 or WEBHOOK_URL):
+    print("Error: BOTS_FILE cannot be combined with WORKERS or WEBHOOK_URL; the bots are served by long polling.")
+    sys.exit(1)
+
+# The supervisor only routes updates; the workers talk to Gemini
+if not SUPERVISOR:
+    if SHARD_INDEX is not None:
+        gemini.initialize_shard(int(SHARD_INDEX), WORKERS)
 
-# Populate API keys in the gemini module
-if GOOGLE_GEMINI_KEY:
-    keys = [key.strip() for key in GOOGLE_GEMINI_KEY.split(',') if key.strip()]
-    gemini.api_keys.extend(keys)
+    # Create one Gemini client per API key
+    if GOOGLE_GEMINI_KEY:
+        keys = [key.strip() for key in GOOGLE_GEMINI_KEY.split(',') if key.strip()]
+        gemini.initialize_key_pool(keys)
 
-# Initialize the Gemini client now that keys are loaded
-gemini.initialize_client()
+    if BOTS is None:
+        # Open the persistent conversation log; sessions are rebuilt from it lazily
+        gemini.initialize_storage(os.getenv("CONVERSATION_DB", conf["conversation_db"]))
+    else:
+        # Each bot has its own sessions, settings and log; bots without keys share GOOGLE_GEMINI_KEY's
+        for config in BOTS:
+            config["tenant"] = gemini.new_tenant(config["name"], config.get("owner_id"), config.get("models"),
+                                                 config.get("system_prompt"), config.get("keys"))
+            gemini.initialize_storage(config["conversation_db"], config["tenant"])
 
 print("Environment variables and API keys loaded.")
+INITIALIZED = time.perf_counter()
 
-async def main():
-    # Init bot
-    bot = AsyncTeleBot(TG_TOKEN)
-    
-    bot_commands = [
-        telebot.types.BotCommand("start", "Start using the bot"),
-        telebot.types.BotCommand("gemini", f"Use {conf['model_1']}"),
-        telebot.types.BotCommand("gemini_pro", f"Use {conf['model_2']}"),
-        telebot.types.BotCommand("draw", "Draw a picture"),
-        telebot.types.BotCommand("edit", "Edit a photo"),
-        telebot.types.BotCommand("clear", "Clear chat history"),
-        telebot.types.BotCommand("switch", "Switch default text model"),
-        telebot.types.BotCommand("system", "Set a custom system prompt"),
-        telebot.types.BotCommand("system_clear", "Delete the system prompt"),
-        telebot.types.BotCommand("system_reset", "Reset the system prompt"),
-        telebot.types.BotCommand("system_show", "Show the current system prompt"),
-        telebot.types.BotCommand("api_add", "Add API key(s)"),
-        telebot.types.BotCommand("api_remove", "Remove an API key"),
-        telebot.types.BotCommand("api_list", "List all API keys"),
-        telebot.types.BotCommand("api_switch", "Switch the current API key")
-    ]
-    
-    # Set bot commands
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    try:
+        with open(STATE_FILE, "w") as f:
+            json.dump(state, f)
+    except OSError as e:
+        print(f"Could not save {STATE_FILE}: {e}")
+
+async def register_commands(bot, bot_commands):
+    """Replace the bot's command list, unless the same list was registered last time"""
+    bot_id = bot.token.split(":", 1)[0]
+    commands_hash = hashlib.sha256(json.dumps([command.to_dict() for command in bot_commands]).encode()).hexdigest()
+    if load_state().get("commands", {}).get(bot_id) == commands_hash:
+        print("Bot commands unchanged.")
+        return
     await bot.delete_my_commands(scope=None, language_code=None)
     await bot.set_my_commands(bot_commands)
+    # Read again: other bots of this process may have saved theirs meanwhile
+    state = load_state()
+    state.setdefault("commands", {})[bot_id] = commands_hash
+    save_state(state)
     print("Bot commands set.")
 
-    # Register all handlers
+def register_handlers(bot):
     bot.register_message_handler(handlers.start,                         commands=['start'],         pass_bot=True)
     bot.register_message_handler(handlers.gemini_stream_handler,         commands=['gemini'],        pass_bot=True)
     bot.register_message_handler(handlers.gemini_pro_stream_handler,     commands=['gemini_pro'],    pass_bot=True)
@@ -79,8 +136,136 @@ async def main():
         content_types=['text'],
         pass_bot=True)
 
+async def supervise(bot):
+    """Run WORKERS worker processes and route the incoming updates to them"""
+    supervisor = shards.Supervisor(WORKERS, run_worker, conf["webhook_queue_size"])
+    supervisor.start()
+    if METRICS_PORT:
+        # On the port after the last worker's
+        await metrics.serve(METRICS_HOST, int(METRICS_PORT) + WORKERS)
+    print(f"Starting Gemini_Telegram_Bot with {WORKERS} workers...")
+    try:
+        if WEBHOOK_URL:
+            if not WEBHOOK_SECRET:
+                print("Warning: WEBHOOK_SECRET is not set, webhook requests will not be verified.")
+            await webhook.serve(bot, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, router=supervisor)
+        else:
+            await shards.poll(bot, supervisor)
+    finally:
+        supervisor.stop()
+
+def bot_commands(tenant):
+    return [
+        telebot.types.BotCommand("start", "Start using the bot"),
+        telebot.types.BotCommand("gemini", f"Use {tenant.model_1}"),
+        telebot.types.BotCommand("gemini_pro", f"Use {tenant.model_2}"),
+        telebot.types.BotCommand("draw", "Draw a picture"),
+        telebot.types.BotCommand("edit", "Edit a photo"),
+        telebot.types.BotCommand("clear", "Clear chat history"),
+        telebot.types.BotCommand("switch", "Switch default text model"),
+        telebot.types.BotCommand("system", "Set a custom system prompt"),
+        telebot.types.BotCommand("system_clear", "Delete the system prompt"),
+        telebot.types.BotCommand("system_reset", "Reset the system prompt"),
+        telebot.types.BotCommand("system_show", "Show the current system prompt"),
+        telebot.types.BotCommand("api_add", "Add API key(s)"),
+        telebot.types.BotCommand("api_remove", "Remove an API key"),
+        telebot.types.BotCommand("api_list", "List all API keys"),
+        telebot.types.BotCommand("api_switch", "Switch the current API key")
+    ]
+
+def new_bot(token, tenant, track_offset=True):
+    """A bot for token that handles each update at most once, logged in tenant's conversation store"""
+    if tenant.conversation_store is None:
+        return AsyncTeleBot(token)
+    # Each worker keeps its own log, as a user's updates always reach the same worker
+    bot_id = token.split(":", 1)[0]
+    if SHARD_INDEX is not None:
+        bot_id += f"/{SHARD_INDEX}"
+    log = updatelog.UpdateLog(tenant.conversation_store, bot_id, conf["stale_update_policy"],
+                              conf["stale_update_max_age"], conf["update_log_size"], track_offset)
+    return updatelog.IdempotentBot(token, log)
+
+async def run_bot(config):
+    """Serve one bot of BOTS_FILE; runs in its own task, so its updates are handled as its tenant's"""
+    tenant = config["tenant"]
+    gemini.current_tenant.set(tenant)
+    bot = new_bot(config["token"], tenant)
+    # One bot failing, e.g. with a revoked token, leaves the others running
+    try:
+        await register_commands(bot, bot_commands(tenant))
+        register_handlers(bot)
+        await bot.delete_webhook()
+        print(f"Bot {tenant.name} started.")
+        await bot.polling(none_stop=True)
+    except Exception as e:
+        print(f"Bot {tenant.name} stopped: {e}")
+
+async def main(updates=None):
+    if BOTS is not None:
+        if METRICS_PORT:
+            await metrics.serve(METRICS_HOST, int(METRICS_PORT))
+        asyncio.get_running_loop().run_in_executor(None, lazy.preload)
+        print(f"Starting Gemini_Telegram_Bot with {len(BOTS)} bots...")
+        await asyncio.gather(*(run_bot(config) for config in BOTS))
+        return
+
+    # Init bot; the supervisor's offset only says which updates were routed, so it is not saved
+    if SUPERVISOR:
+        bot = AsyncTeleBot(TG_TOKEN)
+    else:
+        bot = new_bot(TG_TOKEN, gemini.default_tenant, track_offset=SHARD_INDEX is None and not WEBHOOK_URL)
+
+    # Workers leave the command list to the supervisor
+    if SHARD_INDEX is None:
+        await register_commands(bot, bot_commands(gemini.default_tenant))
+
+    if SUPERVISOR:
+        await supervise(bot)
+        return
+
+    # Register all handlers
+    register_handlers(bot)
+
+    if METRICS_PORT:
+        # Each worker serves its own metrics, on the port after the previous worker's
+        await metrics.serve(METRICS_HOST, int(METRICS_PORT) + int(SHARD_INDEX or 0))
+
+    if MEASURE_STARTUP:
+        ready = time.perf_counter()
+        print(f"Startup: imports {IMPORTED - STARTED:.3f}s, keys and storage {INITIALIZED - IMPORTED:.3f}s, "
+              f"bot setup {ready - INITIALIZED:.3f}s, total {ready - STARTED:.3f}s")
+        started = time.perf_counter()
+        lazy.preload()
+        print(f"Deferred imports (google.genai, Pillow): {time.perf_counter() - started:.3f}s")
+        return
+
+    # Load the deferred libraries in the background so the first request does not wait for them
+    asyncio.get_running_loop().run_in_executor(None, lazy.preload)
+
+    if updates is not None:
+        print(f"Worker {SHARD_INDEX} ready.")
+        sync = asyncio.create_task(gemini.sync_key_state())
+        try:
+            await shards.serve_worker(bot, updates)
+        finally:
+            sync.cancel()
+        return
+
     print("Starting Gemini_Telegram_Bot...")
-    await bot.polling(none_stop=True)
+    if WEBHOOK_URL:
+        if not WEBHOOK_SECRET:
+            print("Warning: WEBHOOK_SECRET is not set, webhook requests will not be verified.")
+        await webhook.serve(bot, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT)
+    else:
+        await bot.delete_webhook()
+        await bot.polling(none_stop=True)
+
+def run_worker(updates):
+    """Entry point of a worker process started by the supervisor"""
+    try:
+        asyncio.run(main(updates))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,165 @@
+import bisect
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+# Seconds; covers a fast Telegram download up to a slow image generation
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge read at scrape time: collect() returns {label values tuple: value}"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self):
+        lines = self.header()
+        try:
+            values = self.collect() if self.collect else {}
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            values = {}
+        for label_values, value in values.items():
+            lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [per-bucket counts, sum, count]
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the time spent in the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = self.header()
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _label_text(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _label_text(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+registry = []
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+telegram_download_seconds = Histogram("telegram_download_seconds", "Time to download a file from Telegram")
+image_encode_seconds = Histogram("image_encode_seconds", "Time to downscale and encode a photo for upload")
+time_to_first_token_seconds = Histogram("gemini_time_to_first_token_seconds", "Time from request to the first streamed chunk", ("model",))
+generation_seconds = Histogram("gemini_generation_seconds", "Time from request to the complete answer", ("model",))
+tokens_total = Counter("gemini_tokens_total", "Prompt and answer tokens reported in usage_metadata", ("model", "direction"))
+telegram_requests_total = Counter("telegram_requests_total", "Telegram API requests by method and result (sent, coalesced, failed, retried)", ("method", "result"))
+rate_limited_total = Counter("gemini_rate_limited_total", "429 answers per API key (last characters of the key)", ("key",))
+key_switches_total = Counter("gemini_key_switches_total", "Requests retried or hedged on another API key")
+requests_shed_total = Counter("gemini_requests_shed_total", "Model requests turned away after waiting longer than the admission deadline", ("model",))
+retries_total = Counter("gemini_retries_total", "Model calls retried, by the kind of error (quota, transient, deadline)", ("kind",))
+messages_merged_total = Counter("bot_messages_merged_total", "Text messages merged into the prompt of an earlier waiting message")
+worker_restarts_total = Counter("bot_worker_restarts_total", "Worker processes started again after exiting, by worker index", ("worker",))
+updates_skipped_total = Counter("telegram_updates_skipped_total", "Updates not handled, by reason (duplicate, stale)", ("reason",))
+hedges_total = Counter("gemini_hedges_total", "Duplicate requests sent after a slow first token, by which request answered first", ("model", "winner"))
+
+
+def record_usage(model, usage_metadata):
+    """Count the tokens of a finished response"""
+    if usage_metadata is None:
+        return
+    prompt_tokens = getattr(usage_metadata, "prompt_token_count", None)
+    answer_tokens = getattr(usage_metadata, "candidates_token_count", None)
+    if prompt_tokens:
+        tokens_total.inc(model, "in", amount=prompt_tokens)
+    if answer_tokens:
+        tokens_total.inc(model, "out", amount=answer_tokens)
+
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE, "Cache-Control": "no-cache"})
+
+
+async def serve(host, port, path="/metrics"):
+    """Serve the metrics endpoint from this process; returns the runner to clean up"""
+    app = web.Application()
+    app.router.add_get(path, handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics listening on {host}:{port}{path}")
+    return runner
@@ -0,0 +1,288 @@
+import asyncio
+import time
+from collections import deque
+from config import conf
+from metrics import telegram_requests_total
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ("chat_id", "func", "args", "kwargs", "future", "coalesce_key")
+
+    def __init__(self, chat_id, func, args, kwargs, coalesce_key):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        self.coalesce_key = coalesce_key
+
+
+def _retry_after(e):
+    """Return Telegram's retry_after for a 429 error, or None for any other error"""
+    if getattr(e, "error_code", None) != 429:
+        return None
+    result_json = getattr(e, "result_json", None) or {}
+    return (result_json.get("parameters") or {}).get("retry_after", 1)
+
+
+class Outbox:
+    """Single outbound queue for every Telegram send/edit/delete of a bot.
+
+    Requests are dispatched per chat in arrival order, paced by a per-chat and a
+    global token bucket. A pending edit of a message is replaced by a newer
+    edit of the same message, so only the newest text is sent, and 429 replies
+    pause the chat for the retry_after Telegram asks for.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._queues = {}        # chat_id -> deque of pending jobs
+        self._edits = {}         # (chat_id, message_id) -> pending edit job
+        self._busy = set()       # chats with a request in flight
+        self._blocked = {}       # chat_id -> monotonic time the chat may send again
+        self._wakeup = None
+        self._task = None
+        self._pruned = time.monotonic()
+        self._sending = set()    # tasks of the requests in flight; the loop only keeps weak references to them
+
+    def queue_depth(self):
+        """Number of requests waiting to be sent"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def enqueue(self, chat_id, func, /, *args, coalesce_key=None, **kwargs):
+        """Queue func(*args, **kwargs) for chat_id and return a future for its result"""
+        self._ensure_running()
+        if coalesce_key is not None:
+            pending = self._edits.get(coalesce_key)
+            if pending is not None:
+                pending.args, pending.kwargs = args, kwargs
+                telegram_requests_total.inc(_method(func), "coalesced")
+                return pending.future
+        job = _Job(chat_id, func, args, kwargs, coalesce_key)
+        if coalesce_key is not None:
+            self._edits[coalesce_key] = job
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self._wakeup.set()
+        return job.future
+
+    def amend(self, coalesce_key, /, *args, **kwargs):
+        """Change the arguments of the queued request with coalesce_key; False if it is not waiting (any more)"""
+        pending = self._edits.get(coalesce_key)
+        if pending is None:
+            return False
+        pending.args, pending.kwargs = args, kwargs
+        return True
+
+    async def submit(self, chat_id, func, /, *args, coalesce_key=None, **kwargs):
+        """Queue func(*args, **kwargs) for chat_id and wait for its result"""
+        future = self.enqueue(chat_id, func, *args, coalesce_key=coalesce_key, **kwargs)
+        return await asyncio.shield(future)
+
+    def _prune_buckets(self, now):
+        """Forget the buckets of idle chats that have refilled, which a new bucket would equal"""
+        self._pruned = now
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id in self._queues or chat_id in self._busy:
+                continue
+            if bucket.full(now):
+                del self._chat_buckets[chat_id]
+
+    def _next_job(self):
+        """Pop the next job allowed to run, or return (None, seconds to wait)"""
+        now = time.monotonic()
+        if now - self._pruned >= 60:
+            self._prune_buckets(now)
+        wait = None
+        global_delay = self.global_bucket.delay(now)
+        for chat_id, queue in self._queues.items():
+            if chat_id in self._busy:
+                continue
+            delay = max(self._blocked.get(chat_id, now) - now, self._bucket(chat_id).delay(now), global_delay)
+            if delay <= 0:
+                job = queue.popleft()
+                if not queue:
+                    del self._queues[chat_id]
+                if job.coalesce_key is not None:
+                    self._edits.pop(job.coalesce_key, None)
+                self._blocked.pop(chat_id, None)
+                self.global_bucket.take(now)
+                self._bucket(chat_id).take(now)
+                return job, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            job, wait = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._busy.add(job.chat_id)
+            task = asyncio.get_running_loop().create_task(self._execute(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _execute(self, job):
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except Exception as e:
+            retry_after = _retry_after(e)
+            if retry_after is None:
+                telegram_requests_total.inc(_method(job.func), "failed")
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            print(f"Telegram flood limit hit for chat {job.chat_id}, retrying in {retry_after}s")
+            telegram_requests_total.inc(_method(job.func), "retried")
+            self._blocked[job.chat_id] = time.monotonic() + retry_after
+            for value in (*job.args, *job.kwargs.values()):
+                if hasattr(value, "seek"):
+                    value.seek(0)
+            if job.coalesce_key is not None:
+                newer = self._edits.get(job.coalesce_key)
+                if newer is not None:
+                    # A newer edit is already queued; it answers both callers.
+                    newer.future.add_done_callback(lambda f, old=job.future: _copy_result(f, old))
+                    return
+                self._edits[job.coalesce_key] = job
+            self._queues.setdefault(job.chat_id, deque()).appendleft(job)
+        else:
+            telegram_requests_total.inc(_method(job.func), "sent")
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._busy.discard(job.chat_id)
+            self._wakeup.set()
+
+
+def _method(func):
+    return getattr(func, "__name__", "unknown")
+
+
+def _copy_result(source, target):
+    if target.done():
+        return
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+outbox = Outbox(conf["telegram_global_rate"], conf["telegram_chat_rate"], conf["telegram_chat_burst"])
+
+# Telegram's rate limits, chat ids and message ids are per bot: each bot token gets its own outbox
+outboxes = {}
+
+def for_bot(bot):
+    """The outbox for bot's requests; the first bot to send uses the module's outbox"""
+    token = getattr(bot, "token", None)
+    box = outboxes.get(token)
+    if box is None:
+        box = outbox if not outboxes else Outbox(conf["telegram_global_rate"], conf["telegram_chat_rate"], conf["telegram_chat_burst"])
+        outboxes[token] = box
+    return box
+
+def queue_depth():
+    """Requests waiting to be sent, across every bot's outbox"""
+    return sum(box.queue_depth() for box in outboxes.values())
+
+
+# Thin wrappers mirroring the AsyncTeleBot methods the bot uses
+async def send_message(bot, chat_id, text, **kwargs):
+    return await for_bot(bot).submit(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+async def reply_to(bot, message, text, **kwargs):
+    return await for_bot(bot).submit(message.chat.id, bot.reply_to, message, text, **kwargs)
+
+async def send_photo(bot, chat_id, photo, **kwargs):
+    return await for_bot(bot).submit(chat_id, bot.send_photo, chat_id, photo, **kwargs)
+
+async def edit_message_text(bot, text, chat_id, message_id, **kwargs):
+    return await for_bot(bot).submit(chat_id, bot.edit_message_text, text=text, chat_id=chat_id, message_id=message_id,
+                               coalesce_key=(chat_id, message_id), **kwargs)
+
+async def delete_message(bot, chat_id, message_id):
+    return await for_bot(bot).submit(chat_id, bot.delete_message, chat_id=chat_id, message_id=message_id)
+
+class PendingReply:
+    """A reply queued without waiting for it to be sent.
+
+    Until it has gone out, replace() can swap its text, e.g. for the first
+    words of an answer that arrived before the placeholder was sent. pages
+    holds the messages a long answer continued in after it.
+    """
+
+    def __init__(self, bot, message, text, **kwargs):
+        self.message = message
+        self.pages = []
+        self._outbox = for_bot(bot)
+        self._key = ("reply", message.chat.id, message.message_id)
+        self._future = self._outbox.enqueue(message.chat.id, bot.reply_to, message, text, coalesce_key=self._key, **kwargs)
+
+    def replace(self, text, **kwargs):
+        """Send text instead if the reply is still queued; False if it is already out"""
+        return self._outbox.amend(self._key, self.message, text, **kwargs)
+
+    async def sent(self):
+        """The sent reply"""
+        return await asyncio.shield(self._future)
+
+def edit_message_text_nowait(bot, text, chat_id, message_id, **kwargs):
+    """Queue an edit without waiting for it; a newer edit of the same message replaces it"""
+    future = for_bot(bot).enqueue(chat_id, bot.edit_message_text, text=text, chat_id=chat_id, message_id=message_id,
+                            coalesce_key=(chat_id, message_id), **kwargs)
+    future.add_done_callback(_log_edit_error)
+    return future
+
+def _log_edit_error(future):
+    if future.cancelled() or future.exception() is None:
+        return
+    if "message is not modified" not in str(future.exception()).lower():
+        print(f"Error editing message: {future.exception()}")
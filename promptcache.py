@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from lazy import types
+from history import CHARS_PER_TOKEN
+from retry import classify, PERMANENT
+
+# A cache this close to expiring is not handed out for a new chat
+EXPIRY_MARGIN = 60
+# Seconds before creating a cache is tried again after a transient failure; doubles on each failure in a row
+RETRY_DELAY = 10
+
+
+class _Entry:
+    __slots__ = ("name", "expires", "client", "refreshing")
+
+    def __init__(self, name, expires, client):
+        self.name = name
+        self.expires = expires
+        self.client = client  # of the key that owns the cache
+        self.refreshing = False
+
+
+class PromptCache:
+    """Gemini cached-content objects holding long system prompts.
+
+    A cache belongs to the API key that created it, so entries are keyed by
+    key, model and a hash of the prompt. Prompts shorter than the model's
+    minimum are sent inline as before. Entries used in the second half of
+    their TTL get their TTL extended in the background; the least recently
+    used entries beyond max_entries are deleted. After a failed creation the
+    key and model send prompts inline for a while: a TTL after a permanent
+    error (e.g. a prompt below the model's minimum), a short, growing
+    backoff after a transient one.
+    """
+
+    def __init__(self, ttl, min_tokens, max_entries, default_min_tokens=4096):
+        self.ttl = ttl
+        self.min_tokens = dict(min_tokens)  # model -> smallest prompt worth caching, in tokens
+        self.default_min_tokens = default_min_tokens
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (key, model, digest) -> _Entry
+        self._creating = {}            # (key, model, digest) -> future of the cache name
+        self._failed_until = {}        # (key, model) -> monotonic time to try creating again
+        self._failures = {}            # (key, model) -> transient creation failures in a row
+        self._tasks = set()
+
+    def qualifies(self, model, prompt):
+        min_tokens = self.min_tokens.get(model, self.default_min_tokens)
+        return bool(prompt) and len(prompt) // CHARS_PER_TOKEN >= min_tokens
+
+    async def config(self, slot, model, prompt, tools):
+        """GenerateContentConfig for a chat with prompt as its system instruction"""
+        name = await self.cache_name(slot, model, prompt, tools) if self.qualifies(model, prompt) else None
+        if name is None:
+            return types.GenerateContentConfig(system_instruction=prompt, tools=tools)
+        # A cached system instruction and tools cannot be repeated in the request
+        return types.GenerateContentConfig(cached_content=name)
+
+    async def cache_name(self, slot, model, prompt, tools):
+        """Name of a live cache of prompt for slot's key, creating it if needed; None if that fails"""
+        key = (slot.key, model, hashlib.sha256(prompt.encode()).hexdigest())
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires - now > EXPIRY_MARGIN:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if entry.expires - now < self.ttl / 2 and not entry.refreshing:
+                self._spawn(self._refresh(entry))
+            return entry.name
+        if self._failed_until.get((slot.key, model), 0) > now:
+            return None
+        pending = self._creating.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        self.misses += 1
+        pending = self._creating[key] = asyncio.get_running_loop().create_future()
+        try:
+            try:
+                name = await self._create(slot, model, prompt, tools)
+            except Exception as e:
+                print(f"Error creating context cache, sending the system prompt inline: {e}")
+                self._failed(slot.key, model, e)
+                name = None
+            else:
+                self._failures.pop((slot.key, model), None)
+                self._entries[key] = _Entry(name, time.monotonic() + self.ttl, slot.client)
+                self._evict()
+            pending.set_result(name)
+            return name
+        finally:
+            if not pending.done():
+                pending.set_result(None)
+            del self._creating[key]
+
+    async def _create(self, slot, model, prompt, tools):
+        cache = await slot.client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(system_instruction=prompt, tools=tools, ttl=f"{self.ttl}s"),
+        )
+        return cache.name
+
+    def _failed(self, key, model, error):
+        if classify(error) == PERMANENT:
+            delay = self.ttl
+        else:
+            failures = self._failures[(key, model)] = self._failures.get((key, model), 0) + 1
+            delay = min(self.ttl, RETRY_DELAY * 2 ** (failures - 1))
+        self._failed_until[(key, model)] = time.monotonic() + delay
+
+    async def _refresh(self, entry):
+        entry.refreshing = True
+        try:
+            await entry.client.aio.caches.update(name=entry.name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"))
+            entry.expires = time.monotonic() + self.ttl
+        except Exception as e:
+            print(f"Error extending context cache {entry.name}: {e}")
+        finally:
+            entry.refreshing = False
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            self._spawn(self._delete(entry))
+
+    def forget_key(self, key):
+        """Drop the entries of a removed API key; its caches expire on their own"""
+        for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == key]:
+            del self._entries[entry_key]
+        for failed in [failed for failed in self._failed_until if failed[0] == key]:
+            del self._failed_until[failed]
+            self._failures.pop(failed, None)
+
+    async def _delete(self, entry):
+        try:
+            await entry.client.aio.caches.delete(name=entry.name)
+        except Exception as e:
+            print(f"Error deleting context cache {entry.name}: {e}")
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,167 @@
+import datetime
+import hashlib
+import time
+from collections import deque
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")  # Gemini daily quotas reset at midnight Pacific time
+except Exception:
+    QUOTA_TIMEZONE = datetime.timezone.utc
+
+WINDOW = 60.0
+# Seconds to wait when other workers' usage alone fills a budget; their
+# timestamps are not known here, only their counts
+SHARED_RECHECK = 1.0
+
+
+def key_id(key):
+    """Stable identifier for an API key that is safe to store"""
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def today():
+    return datetime.datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+
+def seconds_until_reset():
+    now = datetime.datetime.now(QUOTA_TIMEZONE)
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), now.tzinfo)
+    return (midnight - now).total_seconds()
+
+
+class _Usage:
+    __slots__ = ("requests", "tokens", "day", "requests_today", "tokens_today")
+
+    def __init__(self, day):
+        self.requests = deque()  # monotonic times of the requests in the last minute
+        self.tokens = deque()    # (monotonic time, prompt tokens) reported in the last minute
+        self.day = day
+        self.requests_today = 0
+        self.tokens_today = 0
+
+    def prune(self, now):
+        while self.requests and now - self.requests[0] >= WINDOW:
+            self.requests.popleft()
+        while self.tokens and now - self.tokens[0][0] >= WINDOW:
+            self.tokens.popleft()
+
+
+class QuotaTracker:
+    """Local model of each API key's rate limits, per model.
+
+    limits maps a model to its requests per minute ("rpm"), prompt tokens per
+    minute ("tpm") and requests per day ("rpd"); a missing or None limit is
+    not enforced. Requests are counted when a key is picked and tokens when
+    the response's usage_metadata arrives, so a key is skipped before the API
+    would answer 429. Daily counters can be saved and restored across restarts.
+    In a sharded bot, the usage of the other workers is added from others.
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.worker = None   # index of this process in a sharded bot, kept apart in saved counters
+        self.others = {}     # (key, model) -> (requests, tokens) in the last minute and requests today, of other workers
+        self._usage = {}     # (key, model) -> _Usage
+        self._dirty = set()  # (key, model) whose daily counters changed since the last save
+
+    def _get(self, key, model):
+        day = today()
+        usage = self._usage.get((key, model))
+        if usage is None:
+            usage = self._usage[(key, model)] = _Usage(day)
+        elif usage.day != day:
+            usage.day = day
+            usage.requests_today = 0
+            usage.tokens_today = 0
+        return usage
+
+    def wait(self, key, model, tokens=0):
+        """Seconds until key can send a request of about tokens prompt tokens to model (0 if now)"""
+        limits = self.limits.get(model)
+        if not limits:
+            return 0.0
+        now = time.monotonic()
+        usage = self._get(key, model)
+        usage.prune(now)
+        other_requests, other_tokens, other_today = self.others.get((key, model), (0, 0, 0))
+        waits = [0.0]
+        rpd = limits.get("rpd")
+        if rpd is not None and usage.requests_today + other_today >= rpd:
+            waits.append(seconds_until_reset())
+        rpm = limits.get("rpm")
+        if rpm is not None and len(usage.requests) + other_requests >= rpm:
+            # The oldest requests have to leave the window until one more fits
+            expiring = len(usage.requests) + other_requests - rpm + 1
+            waits.append(usage.requests[expiring - 1] + WINDOW - now if expiring <= len(usage.requests) else SHARED_RECHECK)
+        tpm = limits.get("tpm")
+        if tpm is not None and (usage.tokens or other_tokens):
+            excess = sum(count for _, count in usage.tokens) + other_tokens + tokens - tpm
+            for sent, count in usage.tokens:
+                if excess <= 0:
+                    break
+                excess -= count
+                waits.append(sent + WINDOW - now)
+            if excess > 0 and other_tokens:
+                waits.append(SHARED_RECHECK)
+        return max(waits)
+
+    def record_request(self, key, model):
+        if model not in self.limits:
+            return
+        usage = self._get(key, model)
+        usage.requests.append(time.monotonic())
+        usage.requests_today += 1
+        self._dirty.add((key, model))
+
+    def record_tokens(self, key, model, tokens):
+        if model not in self.limits or not tokens:
+            return
+        usage = self._get(key, model)
+        usage.tokens.append((time.monotonic(), tokens))
+        usage.tokens_today += tokens
+        self._dirty.add((key, model))
+
+    def usage_today(self, key, model):
+        """(requests, prompt tokens) sent with key to model today"""
+        usage = self._get(key, model)
+        return usage.requests_today, usage.tokens_today
+
+    def snapshot(self):
+        """(key, model, requests and tokens in the last minute, day, requests today) of this process's usage"""
+        now = time.monotonic()
+        rows = []
+        for (key, model), usage in self._usage.items():
+            usage.prune(now)
+            rows.append((key, model, len(usage.requests), sum(count for _, count in usage.tokens), usage.day, usage.requests_today))
+        return rows
+
+    def _stored_id(self, key):
+        return key_id(key) if self.worker is None else f"{key_id(key)}/{self.worker}"
+
+    def forget_key(self, key):
+        for entry in [entry for entry in self._usage if entry[0] == key]:
+            del self._usage[entry]
+            self._dirty.discard(entry)
+
+    def changed_rows(self):
+        """(key id, model, day, requests, tokens) of the counters changed since the last call"""
+        rows = []
+        for key, model in self._dirty:
+            usage = self._usage.get((key, model))
+            if usage is not None:
+                rows.append((self._stored_id(key), model, usage.day, usage.requests_today, usage.tokens_today))
+        self._dirty.clear()
+        return rows
+
+    def restore(self, keys, rows):
+        """Load today's counters saved by changed_rows() for the API keys in keys"""
+        by_id = {self._stored_id(key): key for key in keys}
+        day = today()
+        for saved_id, model, saved_day, requests, tokens in rows:
+            key = by_id.get(saved_id)
+            if key is None or saved_day != day or model not in self.limits:
+                continue
+            usage = self._get(key, model)
+            usage.requests_today = max(usage.requests_today, requests)
+            usage.tokens_today = max(usage.tokens_today, tokens)
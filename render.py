@@ -0,0 +1,200 @@
+from md2tgmd import escape
+
+FENCE = "```"
+BLOCK_SEPARATOR = "\n\n"
+
+
+def escape_block(block, leading=False):
+    """Escape a single paragraph the same way it would be escaped inside a full answer"""
+    if leading:
+        return escape(block)
+    escaped = escape(BLOCK_SEPARATOR + block)
+    if escaped.startswith(BLOCK_SEPARATOR):
+        return escaped[len(BLOCK_SEPARATOR):]
+    return escaped
+
+
+def _fence_opener(text):
+    """Return the line that opened the last code fence in text"""
+    start = text.rfind(FENCE)
+    end = text.find("\n", start)
+    return text[start:] if end == -1 else text[start:end]
+
+
+def hard_split(raw, limit):
+    """Split raw text whose escaped form is longer than limit at the last newline
+    (or space) that keeps the escaped head within limit. A code fence left open
+    by the cut is closed on the head and reopened on the rest."""
+    cut = min(len(raw), limit)
+    while cut > 1:
+        end = raw.rfind("\n", 0, cut)
+        if end <= 0:
+            end = raw.rfind(" ", 0, cut)
+        if end <= 0:
+            end = cut
+        head, rest = raw[:end], raw[end:]
+        if rest.startswith("\n"):
+            rest = rest[1:]
+        if head.count(FENCE) % 2:
+            rest = _fence_opener(head) + "\n" + rest
+            head += "\n" + FENCE
+        if len(escape(head)) <= limit:
+            return head, rest
+        cut = end * 3 // 4
+    return raw[:1], raw[1:]
+
+
+class StreamRenderer:
+    """Incremental MarkdownV2 renderer for streamed answers.
+
+    Finished paragraphs and closed code fences are escaped once and kept as a
+    stable prefix; only the still-open tail is re-escaped on every render, so
+    the per-tick cost depends on the tail length instead of the answer length.
+    """
+
+    def __init__(self):
+        self._raw = []          # every chunk received, joined only on demand
+        self._pending = []      # chunks not yet folded into the tail
+        self._tail = ""         # raw text after the last stable boundary
+        self._stable = []       # escaped stable blocks
+        self._stable_raw = []   # raw text of each stable block, separator included
+        self._stable_text = ""  # cached "".join(self._stable)
+
+    def feed(self, text):
+        """Append a streamed chunk"""
+        if text:
+            self._raw.append(text)
+            self._pending.append(text)
+
+    @property
+    def text(self):
+        """The raw, unescaped answer so far"""
+        return "".join(self._raw)
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._raw)
+
+    def _fold(self):
+        if not self._pending:
+            return
+        self._tail += "".join(self._pending)
+        self._pending.clear()
+
+        # Walk the tail paragraph by paragraph and freeze every paragraph that
+        # is followed by a blank line and does not leave a code fence open.
+        start = 0
+        cut = 0
+        open_fence = False
+        while True:
+            end = self._tail.find(BLOCK_SEPARATOR, start)
+            if end == -1:
+                break
+            if self._tail.count(FENCE, start, end) % 2:
+                open_fence = not open_fence
+            start = end + len(BLOCK_SEPARATOR)
+            if not open_fence:
+                cut = start
+        if not cut:
+            return
+
+        added = []
+        for block in self._tail[:cut].split(BLOCK_SEPARATOR)[:-1]:
+            if added and self._fence_open(added[-1]):
+                added[-1] += BLOCK_SEPARATOR + block
+            else:
+                added.append(block)
+        for block in added:
+            leading = not self._stable
+            self._stable.append(escape_block(block + BLOCK_SEPARATOR, leading))
+            self._stable_raw.append(block + BLOCK_SEPARATOR)
+        self._stable_text = "".join(self._stable)
+        self._tail = self._tail[cut:]
+
+    @staticmethod
+    def _fence_open(block):
+        return block.count(FENCE) % 2 == 1
+
+    def render(self):
+        """Return the escaped answer so far"""
+        self._fold()
+        if not self._tail:
+            return self._stable_text
+        return self._stable_text + escape_block(self._tail, leading=not self._stable)
+
+    def split_page(self, limit):
+        """Cut a finished page off the front once the rendered answer is longer than limit.
+
+        Returns (escaped_page, raw_page, raw_rest), or None if everything still fits.
+        Pages end on a paragraph boundary whenever one fits within the limit.
+        """
+        if len(self.render()) <= limit:
+            return None
+        size = count = 0
+        for escaped in self._stable:
+            if size + len(escaped) > limit:
+                break
+            size += len(escaped)
+            count += 1
+        if count:
+            page = "".join(self._stable[:count])
+            raw_page = "".join(self._stable_raw[:count])
+            raw_rest = "".join(self._stable_raw[count:]) + self._tail
+        else:
+            raw_page, raw_rest = hard_split("".join(self._stable_raw) + self._tail, limit)
+            page = escape(raw_page)
+        return page, raw_page, raw_rest
+
+
+class StreamPager:
+    """Splits a streamed answer into Telegram-sized pages.
+
+    Only the last page is ever rendered again; finished pages are handed out
+    once through pop_pages() so the caller can freeze them in their own message.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._raw = []
+        self._page = StreamRenderer()
+
+    def feed(self, text):
+        """Append a streamed chunk"""
+        if text:
+            self._raw.append(text)
+            self._page.feed(text)
+
+    @property
+    def text(self):
+        """The raw, unescaped answer so far, across all pages"""
+        return "".join(self._raw)
+
+    @property
+    def page_text(self):
+        """The raw text of the current (last) page"""
+        return self._page.text
+
+    def pop_pages(self):
+        """Return the pages finished since the last call as (escaped, raw) pairs"""
+        pages = []
+        while True:
+            split = self._page.split_page(self.limit)
+            if split is None:
+                return pages
+            page, raw_page, raw_rest = split
+            pages.append((page, raw_page))
+            self._page = StreamRenderer()
+            self._page.feed(raw_rest)
+
+    def render(self):
+        """Return the escaped current page"""
+        return self._page.render()
+
+
+def paginate(text, limit):
+    """Split a complete answer into (escaped, raw) pages of at most limit characters"""
+    pager = StreamPager(limit)
+    pager.feed(text)
+    pages = pager.pop_pages()
+    if pager.page_text.strip():
+        pages.append((pager.render(), pager.page_text))
+    return pages
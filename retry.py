@@ -0,0 +1,138 @@
+import asyncio
+import random
+import re
+from metrics import retries_total
+
+# Error classes, see classify()
+QUOTA = "quota"
+TRANSIENT = "transient"
+DEADLINE = "deadline"
+PERMANENT = "permanent"
+
+TRANSIENT_CODES = {500, 502, 503, 504}
+RETRY_DELAY = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class NoKeyAvailable(Exception):
+    """Every API key is cooling down for longer than the call may wait"""
+
+
+def classify(e):
+    """Sort an exception from a Gemini call into QUOTA, TRANSIENT, DEADLINE or PERMANENT"""
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return DEADLINE
+    code = getattr(e, "code", None)
+    if not isinstance(code, int):
+        code = getattr(e, "status_code", None)
+    text = str(e)
+    if code == 429 or "RESOURCE_EXHAUSTED" in text:
+        return QUOTA
+    if code == 408 or "DEADLINE_EXCEEDED" in text:
+        return DEADLINE
+    if code in TRANSIENT_CODES or "UNAVAILABLE" in text:
+        return TRANSIENT
+    # httpx and aiohttp connection failures and read timeouts
+    name = type(e).__name__
+    if isinstance(e, ConnectionError) or "Timeout" in name or "Connect" in name or "RemoteProtocol" in name:
+        return TRANSIENT
+    return PERMANENT
+
+
+def server_retry_delay(e):
+    """The retryDelay the API asked for in a 429 or 503, in seconds, or None"""
+    match = RETRY_DELAY.search(str(getattr(e, "details", None) or e))
+    return float(match.group(1)) if match else None
+
+
+class Attempt:
+    """One try of a call: the key it runs on and the keys tried so far.
+
+    The call may replace slot (e.g. when a hedged request on another key
+    wins); the executor then releases the replacement instead.
+    """
+    __slots__ = ("slot", "number", "tried")
+
+    def __init__(self, slot, number, tried):
+        self.slot = slot
+        self.number = number
+        self.tried = tried
+
+
+class RetryExecutor:
+    """Runs Gemini calls on the key pool with retries.
+
+    Quota errors put the key in a cooldown (the server's retryDelay if it gave
+    one) and move on to another key, waiting for a key to recover when all
+    are cooling down or out of local quota. Transient server errors and timeouts are retried after a
+    jittered exponential backoff. Permanent errors are raised at once. No
+    attempt starts after the call's deadline.
+    """
+
+    def __init__(self, key_pool, max_attempts, deadline, base_delay=1.0, max_delay=30.0):
+        self.key_pool = key_pool
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, number, server_delay=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (number - 1)))
+        return max(delay, server_delay or 0)
+
+    def _acquire(self, tried, model, tokens):
+        # Prefer a key this call has not failed on yet, but any healthy key will do
+        return self.key_pool.acquire(tried, model, tokens) or self.key_pool.acquire((), model, tokens)
+
+    async def run(self, call, model=None, tokens=0, timeout=None, on_retry=None, deadline=None):
+        """Return await call(attempt), retrying as described above.
+
+        model and tokens (estimated prompt tokens) pick a key with quota left.
+        timeout bounds each attempt; deadline (default: the executor's) bounds
+        the whole call. on_retry(error, kind, delay) is awaited before a retry.
+        Raises NoKeyAvailable if no key is usable in time.
+        """
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + (self.deadline if deadline is None else deadline)
+        tried = set()
+        number = 0
+        while True:
+            slot = self._acquire(tried, model, tokens)
+            if slot is None:
+                wait = self.key_pool.next_ready(model, tokens)
+                if wait is None or loop.time() + wait > give_up_at:
+                    raise NoKeyAvailable("all API keys are cooling down or out of quota")
+                await asyncio.sleep(wait)
+                continue
+            number += 1
+            tried.add(slot)
+            attempt = Attempt(slot, number, tried)
+            try:
+                if timeout is None:
+                    result = await call(attempt)
+                else:
+                    result = await asyncio.wait_for(call(attempt), timeout)
+            except Exception as e:
+                kind = classify(e)
+                server_delay = server_retry_delay(e)
+                if kind == QUOTA:
+                    self.key_pool.release(attempt.slot, "rate_limited", retry_after=server_delay)
+                else:
+                    self.key_pool.release(attempt.slot, "error")
+                if kind == PERMANENT or number >= self.max_attempts:
+                    raise
+                # Another key can take a quota retry right away; otherwise back off
+                delay = 0 if kind == QUOTA else self.backoff(number, server_delay)
+                if loop.time() + delay > give_up_at:
+                    raise
+                retries_total.inc(kind)
+                print(f"Gemini call failed ({kind}, attempt {number}), retrying in {delay:.1f}s: {str(e) or type(e).__name__}")
+                if on_retry is not None:
+                    await on_retry(e, kind, delay)
+                if delay:
+                    await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.key_pool.release(attempt.slot, "cancelled")
+                raise
+            self.key_pool.release(attempt.slot)
+            return result
@@ -0,0 +1,109 @@
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+def history_size(value):
+    """Approximate bytes held by a session value; for chats this is the text and inline data of the history"""
+    get_history = getattr(value, "get_history", None)
+    if get_history is None:
+        return sys.getsizeof(value)
+    size = 0
+    for content in get_history():
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "text", None):
+                size += len(part.text)
+            inline_data = getattr(part, "inline_data", None)
+            if inline_data is not None and inline_data.data:
+                size += len(inline_data.data)
+    return size
+
+
+class SessionStore(MutableMapping):
+    """Dict of per-user state with LRU eviction.
+
+    Entries idle for longer than idle_ttl seconds are dropped, and the least
+    recently used entries are evicted once the store holds more than
+    max_entries entries or max_bytes bytes (as measured by sizeof).
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, idle_ttl=None, sizeof=history_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> [value, size, last_used], least recently used first
+
+    def _expired(self, entry, now):
+        return self.idle_ttl is not None and now - entry[2] > self.idle_ttl
+
+    def __getitem__(self, key):
+        entry = self._data[key]
+        now = time.monotonic()
+        if self._expired(entry, now):
+            self._pop(key)
+            self.evictions += 1
+            raise KeyError(key)
+        entry[2] = now
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._pop(key)
+        size = self.sizeof(value)
+        self._data[key] = [value, size, time.monotonic()]
+        self.total_bytes += size
+        self._evict()
+
+    def __delitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        self._pop(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def _pop(self, key):
+        value, size, _ = self._data.pop(key)
+        self.total_bytes -= size
+        return value
+
+    def update_size(self, key):
+        """Re-measure an entry whose value grew in place, e.g. a chat after a new turn"""
+        entry = self._data.get(key)
+        if entry is None:
+            return
+        size = self.sizeof(entry[0])
+        self.total_bytes += size - entry[1]
+        entry[1] = size
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._data:
+            key, entry = next(iter(self._data.items()))
+            if not self._expired(entry, now):
+                break
+            self._pop(key)
+            self.evictions += 1
+        # The most recently used entry is always kept, even if it alone is over the limits.
+        while len(self._data) > 1 and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            self._pop(next(iter(self._data)))
+            self.evictions += 1
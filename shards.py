@@ -0,0 +1,213 @@
+import asyncio
+import multiprocessing
+import os
+import time
+import traceback
+from collections import deque
+from telebot import asyncio_helper
+from telebot.types import Update
+from config import conf
+from metrics import worker_restarts_total
+import webhook
+
+
+def shard_of(update, count):
+    """The worker (0 to count - 1) for a raw update, chosen by the user who sent it.
+
+    Every update of a user lands on the same worker, so their chat sessions
+    and per-user state stay in one process. Updates without a user fall
+    back to their chat, then to worker 0.
+    """
+    for name, value in update.items():
+        if name == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user and "id" in user:
+            return user["id"] % count
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"] % count
+    return 0
+
+
+class Supervisor:
+    """Runs count worker processes and routes each raw update to its user's worker.
+
+    Each worker reads its updates from a pipe of its own, fed from a backlog
+    in this process, so a slow worker does not hold up the others. A worker
+    that exits is started again on a fresh pipe: a dead reader can leave a
+    shared queue locked, and what it had not read yet is taken back into the
+    backlog, so the updates routed to it in the meantime are not lost. One
+    that keeps crashing is restarted after a growing delay.
+    """
+
+    def __init__(self, count, target, queue_size):
+        self.count = count
+        self.target = target  # called as target(connection) in each worker process
+        self.queue_size = queue_size  # updates a worker's backlog holds before more are refused
+        # spawn, not fork: the parent holds an event loop, sockets and SQLite connections
+        self._context = multiprocessing.get_context("spawn")
+        self.backlogs = [deque() for _ in range(count)]
+        self.processes = [None] * count
+        self._readers = [None] * count
+        self._writers = [None] * count
+        self._started = [0.0] * count
+        self._delays = [0.0] * count
+        self._wakeups = [asyncio.Event() for _ in range(count)]
+        self._senders = []
+
+    def start(self):
+        for index in range(self.count):
+            self._start_worker(index)
+        self._senders = [asyncio.create_task(self._send(index)) for index in range(self.count)]
+
+    def _start_worker(self, index):
+        reader, writer = self._context.Pipe(duplex=False)
+        # The worker reads its index at import time, before its target runs
+        os.environ["SHARD_INDEX"] = str(index)
+        try:
+            process = self._context.Process(target=self.target, args=(reader,), name=f"worker-{index}", daemon=True)
+            process.start()
+        finally:
+            del os.environ["SHARD_INDEX"]
+        # The reader end stays open here too, to take back what a dead worker did not read
+        self._readers[index] = reader
+        self._writers[index] = writer
+        self.processes[index] = process
+        self._started[index] = time.monotonic()
+        print(f"Worker {index} started (pid {process.pid})")
+
+    async def _send(self, index):
+        """Move the worker's backlog into its pipe, restarting the worker when it exits"""
+        loop = asyncio.get_running_loop()
+        backlog = self.backlogs[index]
+        wakeup = self._wakeups[index]
+        while True:
+            if not self.processes[index].is_alive():
+                await self._restart(index)
+                continue
+            if not backlog:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            update = backlog.popleft()
+            sending = loop.run_in_executor(None, self._writers[index].send, update)
+            try:
+                # A full pipe blocks the send until the worker reads or is found dead
+                while not (await asyncio.wait({sending}, timeout=1.0))[0]:
+                    if not self.processes[index].is_alive():
+                        await self._restart(index, sending)
+                        break
+            except asyncio.CancelledError:
+                # Stopping: the send fails once stop() closes the reader end
+                sending.add_done_callback(lambda future: future.exception())
+                raise
+            if sending.done() and sending.exception() is not None:
+                print(f"Error sending an update to worker {index}: {sending.exception()}")
+                backlog.appendleft(update)
+                await asyncio.sleep(1)
+
+    async def _restart(self, index, sending=None):
+        process = self.processes[index]
+        if time.monotonic() - self._started[index] < 60:
+            self._delays[index] = min(60.0, max(conf["worker_restart_delay"], self._delays[index] * 2))
+        else:
+            self._delays[index] = conf["worker_restart_delay"]
+        print(f"Worker {index} exited with code {process.exitcode}, restarting in {self._delays[index]:g}s")
+        unread = await asyncio.to_thread(self._take_back, index, sending)
+        self.backlogs[index].extendleft(reversed(unread))
+        await asyncio.sleep(self._delays[index])
+        worker_restarts_total.inc(index)
+        self._start_worker(index)
+
+    def _take_back(self, index, sending=None):
+        """The updates in the dead worker's pipe, read until the send in progress (if any) is through"""
+        reader, writer = self._readers[index], self._writers[index]
+        unread = []
+        try:
+            while reader.poll(0.1) or (sending is not None and not sending.done()):
+                if reader.poll(0):
+                    unread.append(reader.recv())
+        except Exception as e:
+            # The worker may have died halfway through reading an update
+            print(f"Error taking back the updates of worker {index}: {e}")
+        reader.close()
+        writer.close()
+        if unread:
+            print(f"Routing {len(unread)} updates worker {index} did not read to its next run")
+        return unread
+
+    def put_nowait(self, update):
+        """Route a raw update; raises asyncio.QueueFull if its worker is too far behind"""
+        index = shard_of(update, self.count)
+        if len(self.backlogs[index]) >= self.queue_size:
+            raise asyncio.QueueFull
+        self.backlogs[index].append(update)
+        self._wakeups[index].set()
+
+    def stop(self):
+        for sender in self._senders:
+            sender.cancel()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(5)
+        # With no reader left, a send still blocked on a full pipe fails instead of hanging
+        for reader in self._readers:
+            if reader is not None:
+                reader.close()
+
+
+async def poll(bot, router):
+    """Long-poll Telegram for raw updates and route them.
+
+    The bot's own polling would parse and handle every update in this
+    process; here they are only handed to the workers. An update whose
+    worker is too far behind is dropped, so the other workers keep getting
+    theirs.
+    """
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await asyncio_helper.get_updates(
+                bot.token, offset, timeout=conf["poll_timeout"], request_timeout=conf["poll_timeout"] + 10)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error getting updates: {e}")
+            await asyncio.sleep(3)
+            continue
+        for update in updates:
+            try:
+                router.put_nowait(update)
+            except asyncio.QueueFull:
+                print(f"Worker {shard_of(update, router.count)} is too far behind, dropping update {update['update_id']}")
+            offset = update["update_id"] + 1
+
+
+async def serve_worker(bot, updates):
+    """Handle the raw updates the supervisor routes to this worker through the updates connection"""
+    queue = asyncio.Queue(maxsize=conf["webhook_queue_size"])
+    dispatcher = asyncio.create_task(webhook.dispatch_updates(bot, queue))
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                update = await loop.run_in_executor(None, updates.recv)
+            except EOFError:
+                print("The supervisor closed the update pipe, stopping")
+                return
+            try:
+                parsed = Update.de_json(update)
+            except Exception:
+                traceback.print_exc()
+                continue
+            await queue.put(parsed)
+    finally:
+        dispatcher.cancel()
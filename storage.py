@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+import time
+from lazy import types
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_by_user ON turns (user_id, model, id);
+CREATE TABLE IF NOT EXISTS settings (
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS key_usage (
+    key_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    day TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (key_id, model, day)
+);
+CREATE TABLE IF NOT EXISTS worker_key_usage (
+    worker INTEGER NOT NULL,
+    key_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    minute_requests INTEGER NOT NULL,
+    minute_tokens INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    day_requests INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (worker, key_id, model)
+);
+CREATE TABLE IF NOT EXISTS key_cooldowns (
+    key_id TEXT PRIMARY KEY,
+    until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS handled_updates (
+    bot_id TEXT NOT NULL,
+    update_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (bot_id, update_id)
+);
+CREATE TABLE IF NOT EXISTS update_offsets (
+    bot_id TEXT PRIMARY KEY,
+    next_update_id INTEGER NOT NULL
+);
+"""
+
+# States of a handled update; an update left "started" by a previous run is "interrupted"
+UPDATE_STARTED = "started"
+UPDATE_DONE = "done"
+UPDATE_INTERRUPTED = "interrupted"
+
+
+class ConversationStore:
+    """SQLite log of conversation turns plus per-user settings.
+
+    Nothing is loaded at startup: a user's history is read back the first time
+    their chat session is needed again. Clearing or rewriting a conversation
+    deletes its earlier rows, so the log only holds current histories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def append_turn(self, user_id, model, contents):
+        """Record the contents (user message and model answer) of one turn"""
+        now = time.time()
+        rows = [(str(user_id), model, content.role, content.model_dump_json(exclude_none=True), now) for content in contents]
+        with self._lock:
+            self._conn.executemany("INSERT INTO turns (user_id, model, role, content, created) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def load_history(self, user_id, model):
+        """Return the user's history with model, as a list of types.Content"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content FROM turns WHERE user_id = ? AND model = ? ORDER BY id", (str(user_id), model)
+            ).fetchall()
+        return [types.Content.model_validate_json(content) for (content,) in rows]
+
+    def clear(self, user_id, models):
+        """Start a fresh conversation for the user with each of models"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM turns WHERE user_id = ? AND model = ?", [(str(user_id), model) for model in models])
+            self._conn.commit()
+
+    def rewrite(self, user_id, model, contents):
+        """Replace the user's history with model by contents, e.g. after compacting it"""
+        now = time.time()
+        rows = [(str(user_id), model, content.role, content.model_dump_json(exclude_none=True), now) for content in contents]
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE user_id = ? AND model = ?", (str(user_id), model))
+            self._conn.executemany("INSERT INTO turns (user_id, model, role, content, created) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def get_setting(self, user_id, name):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM settings WHERE user_id = ? AND name = ?", (str(user_id), name)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, user_id, name, value):
+        with self._lock:
+            if value is None:
+                self._conn.execute("DELETE FROM settings WHERE user_id = ? AND name = ?", (str(user_id), name))
+            else:
+                self._conn.execute("INSERT OR REPLACE INTO settings (user_id, name, value) VALUES (?, ?, ?)", (str(user_id), name, value))
+            self._conn.commit()
+
+    def load_key_usage(self, day):
+        """Daily API key counters saved with save_key_usage() for day, as (key_id, model, day, requests, tokens)"""
+        with self._lock:
+            return self._conn.execute("SELECT key_id, model, day, requests, tokens FROM key_usage WHERE day = ?", (day,)).fetchall()
+
+    def save_key_usage(self, rows):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO key_usage (key_id, model, day, requests, tokens) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("DELETE FROM key_usage WHERE day < date('now', '-7 days')")
+            self._conn.commit()
+
+    def exchange_key_state(self, worker, usage, cooldowns, stale_after=120):
+        """Publish a worker's API key usage and cooldowns and read back the other workers'.
+
+        usage is (key_id, model, requests and tokens in the last minute, day,
+        requests today) and cooldowns maps key_id to the wall-clock time the
+        key's cooldown ends. Returns the other workers' usage rows updated in
+        the last stale_after seconds, and every cooldown still running.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO worker_key_usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(worker, *row, now) for row in usage],
+            )
+            self._conn.executemany(
+                "INSERT INTO key_cooldowns (key_id, until) VALUES (?, ?) "
+                "ON CONFLICT (key_id) DO UPDATE SET until = MAX(until, excluded.until)",
+                list(cooldowns.items()),
+            )
+            self._conn.execute("DELETE FROM key_cooldowns WHERE until <= ?", (now,))
+            self._conn.commit()
+            others = self._conn.execute(
+                "SELECT key_id, model, minute_requests, minute_tokens, day, day_requests FROM worker_key_usage "
+                "WHERE worker != ? AND updated > ?",
+                (worker, now - stale_after),
+            ).fetchall()
+            running = dict(self._conn.execute("SELECT key_id, until FROM key_cooldowns").fetchall())
+        return others, running
+
+    def claim_update(self, bot_id, update_id):
+        """Record that the bot starts handling update_id; False if it was handled before or is being handled now"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO handled_updates (bot_id, update_id, state, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (bot_id, update_id) DO UPDATE SET state = excluded.state, updated = excluded.updated "
+                "WHERE state = ?",
+                (bot_id, update_id, UPDATE_STARTED, time.time(), UPDATE_INTERRUPTED),
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def finish_update(self, bot_id, update_id, next_update_id=None, keep=10000):
+        """Mark update_id handled, save the offset polling resumes from, and forget all but the last keep update ids"""
+        with self._lock:
+            self._conn.execute("UPDATE handled_updates SET state = ?, updated = ? WHERE bot_id = ? AND update_id = ?",
+                               (UPDATE_DONE, time.time(), bot_id, update_id))
+            if next_update_id is not None:
+                # Updates finish out of order; the offset only moves forward
+                self._conn.execute("INSERT INTO update_offsets (bot_id, next_update_id) VALUES (?, ?) "
+                                   "ON CONFLICT (bot_id) DO UPDATE SET next_update_id = MAX(next_update_id, excluded.next_update_id)",
+                                   (bot_id, next_update_id))
+            self._conn.execute("DELETE FROM handled_updates WHERE bot_id = ? AND update_id < ?", (bot_id, update_id - keep))
+            self._conn.commit()
+
+    def interrupt_updates(self, bot_id):
+        """Mark the updates a previous run was still handling as interrupted, so a redelivery is handled again"""
+        with self._lock:
+            self._conn.execute("UPDATE handled_updates SET state = ? WHERE bot_id = ? AND state = ?",
+                               (UPDATE_INTERRUPTED, bot_id, UPDATE_STARTED))
+            self._conn.commit()
+
+    def load_update_offset(self, bot_id):
+        """The update id the bot's polling resumes from, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT next_update_id FROM update_offsets WHERE bot_id = ?", (bot_id,)).fetchone()
+        return row[0] if row else None
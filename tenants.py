@@ -0,0 +1,51 @@
+from config import conf
+from sessions import SessionStore
+
+
+# Chat sessions are capped in count, memory and idle time; per-user settings only in count and idle time
+def new_chat_store():
+    return SessionStore(conf["session_max_entries"], conf["session_max_bytes"], conf["session_idle_ttl"])
+
+def new_settings_store():
+    return SessionStore(conf["settings_max_entries"], None, conf["settings_idle_ttl"])
+
+
+class Tenant:
+    """One bot served by this process and the state that belongs to it alone.
+
+    Chat sessions, per-user settings, pending history compactions and the
+    database they are kept in are never shared between tenants, so the same
+    user talking to two bots has two separate histories. The key pool and
+    its retry executor may be shared with other tenants.
+    """
+
+    def __init__(self, name, owner_id, models, system_prompt, key_pool, retry_executor):
+        self.name = name
+        self.owner_id = owner_id  # None: the OWNER_ID environment variable
+        self.model_1 = models["model_1"]
+        self.model_2 = models["model_2"]
+        self.model_3 = models["model_3"]
+        self.system_prompt = system_prompt  # for users who did not set their own
+        self.key_pool = key_pool
+        self.retry_executor = retry_executor
+        self.gemini_chat_dict = new_chat_store()
+        self.gemini_pro_chat_dict = new_chat_store()
+        self.gemini_draw_dict = new_chat_store()
+        self.default_model_dict = new_settings_store()
+        self.user_system_prompt_dict = new_settings_store()
+        self.conversation_store = None
+        self.pending_compactions = {}  # (model, user_id) -> (replaced count, last replaced content, replacement)
+        self.compacting = set()
+        self.last_usage_save = 0.0
+
+    @property
+    def models(self):
+        return (self.model_1, self.model_2, self.model_3)
+
+    @property
+    def api_keys(self):
+        return self.key_pool.keys
+
+    def __repr__(self):
+        return f"<Tenant {self.name!r}>"
+
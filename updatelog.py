@@ -0,0 +1,118 @@
+import asyncio
+import time
+from telebot.async_telebot import AsyncTeleBot
+from metrics import updates_skipped_total
+
+# Update fields that carry a message, whose date tells how old the update is
+DATED_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post", "business_message", "edited_business_message")
+
+# Stale update policies, see UpdateLog
+ANSWER = "answer"
+SKIP = "skip"
+RECENT = "recent"
+
+
+def update_date(update):
+    """Unix time the update's message was sent, or None if it carries no message"""
+    for field in DATED_FIELDS:
+        message = getattr(update, field, None)
+        if message is not None:
+            return message.date
+    return None
+
+
+class UpdateLog:
+    """Which of a bot's updates were handled, kept in the conversation database.
+
+    An update is claimed before its handlers run and marked done after, so
+    an update Telegram delivers again after a restart is not answered twice.
+    An update a crashed run was still handling is handled again if it comes
+    back; with polling that is rare, as each batch of updates is confirmed
+    when the next one is asked for. Updates sent before this run started are
+    stale: policy ANSWER handles them, SKIP drops them and RECENT handles
+    only those younger than max_age seconds. With track_offset, the id after
+    the highest update seen is saved, so polling resumes there.
+    """
+
+    def __init__(self, store, bot_id, policy=ANSWER, max_age=None, keep=10000, track_offset=True):
+        if policy not in (ANSWER, SKIP, RECENT):
+            raise ValueError(f"unknown stale update policy {policy!r}")
+        self.store = store
+        self.bot_id = bot_id
+        self.policy = policy
+        self.max_age = max_age
+        self.keep = keep
+        self.track_offset = track_offset
+        self.started = time.time()
+        self.highest = None
+        store.interrupt_updates(bot_id)
+
+    def offset(self):
+        """The update id polling should resume from, or None"""
+        return self.store.load_update_offset(self.bot_id) if self.track_offset else None
+
+    def is_stale(self, update, now=None):
+        """Whether the stale policy drops update"""
+        if self.policy == ANSWER:
+            return False
+        date = update_date(update)
+        if date is None or date >= self.started:
+            return False
+        if self.policy == SKIP:
+            return True
+        now = time.time() if now is None else now
+        return now - date > self.max_age
+
+    async def claim(self, update):
+        """Whether the bot should handle update now; if so, call finish() once it is handled"""
+        update_id = update.update_id
+        self.highest = update_id if self.highest is None else max(self.highest, update_id)
+        if self.is_stale(update):
+            updates_skipped_total.inc("stale")
+            print(f"Skipping stale update {update_id} from {time.time() - update_date(update):.0f}s ago")
+            return False
+        try:
+            claimed = await asyncio.to_thread(self.store.claim_update, self.bot_id, update_id)
+        except Exception as e:
+            # Better a possible duplicate than a dropped message
+            print(f"Error claiming update {update_id}: {e}")
+            claimed = True
+        if not claimed:
+            updates_skipped_total.inc("duplicate")
+            print(f"Update {update_id} was already handled, skipping it")
+        return claimed
+
+    async def finish(self, update):
+        update_id = update.update_id
+        next_update_id = self.highest + 1 if self.track_offset else None
+        try:
+            await asyncio.to_thread(self.store.finish_update, self.bot_id, update_id, next_update_id, self.keep)
+        except Exception as e:
+            print(f"Error recording update {update_id}: {e}")
+
+
+class IdempotentBot(AsyncTeleBot):
+    """AsyncTeleBot that hands each update to its handlers at most once, per update_log.
+
+    Polling resumes from the offset saved in the log. Without a log it
+    behaves like AsyncTeleBot.
+    """
+
+    def __init__(self, token, update_log=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.update_log = update_log
+        if update_log is not None and self.offset is None:
+            self.offset = update_log.offset()
+
+    async def process_new_updates(self, updates):
+        if self.update_log is None:
+            return await super().process_new_updates(updates)
+        await asyncio.gather(*(self._process_once(update) for update in updates))
+
+    async def _process_once(self, update):
+        if not await self.update_log.claim(update):
+            return
+        try:
+            await super().process_new_updates([update])
+        finally:
+            await self.update_log.finish(update)
@@ -0,0 +1,73 @@
+import asyncio
+from collections import deque
+from config import conf
+from metrics import messages_merged_total
+
+
+class _Job:
+    __slots__ = ("func", "merge_key", "texts", "future", "started")
+
+    def __init__(self, func, merge_key, text):
+        self.func = func
+        self.merge_key = merge_key
+        self.texts = None if text is None else [text]
+        self.future = asyncio.get_running_loop().create_future()
+        self.started = False
+
+
+class UserQueue:
+    """Runs each user's jobs one at a time in arrival order; different users run in parallel.
+
+    A text job can name a merge_key: if it arrives while an earlier text job
+    with the same key is still waiting, its text is appended to that job
+    instead of producing a second request. merge_window is how long such a
+    job waits for follow-up messages before it starts.
+    """
+
+    def __init__(self, merge_window=0):
+        self.merge_window = merge_window
+        self._queues = {}   # user_id -> deque of waiting jobs
+        self._workers = {}  # user_id -> worker task
+
+    async def submit(self, user_id, func, merge_key=None, text=None):
+        """Queue func for user_id and wait until it has run.
+
+        func is called with no arguments, or with the (merged) text if text is given.
+        """
+        queue = self._queues.setdefault(user_id, deque())
+        if merge_key is not None and text is not None and queue:
+            last = queue[-1]
+            if last.merge_key == merge_key and last.texts is not None and not last.started:
+                last.texts.append(text)
+                messages_merged_total.inc()
+                return await asyncio.shield(last.future)
+        job = _Job(func, merge_key, text)
+        queue.append(job)
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._work(user_id))
+        return await asyncio.shield(job.future)
+
+    async def _work(self, user_id):
+        queue = self._queues[user_id]
+        try:
+            while queue:
+                job = queue[0]
+                if job.merge_key is not None and self.merge_window:
+                    await asyncio.sleep(self.merge_window)
+                queue.popleft()
+                job.started = True
+                try:
+                    if job.texts is None:
+                        result = await job.func()
+                    else:
+                        result = await job.func("\n\n".join(job.texts))
+                    job.future.set_result(result)
+                except Exception as e:
+                    job.future.set_exception(e)
+        finally:
+            del self._workers[user_id]
+            if not queue:
+                del self._queues[user_id]
+
+
+user_queue = UserQueue(conf["merge_window"])
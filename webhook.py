@@ -0,0 +1,96 @@
+import asyncio
+import json
+import traceback
+from urllib.parse import urlparse
+from aiohttp import web
+from telebot.types import Update
+from config import conf
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def dispatch_updates(bot, queue):
+    """Hand each queued update to the bot's handlers in a task of its own.
+
+    A handler can wait a long time behind its user's earlier requests and for
+    a free generation slot, so handlers are not awaited here; at most
+    conf["update_handlers"] run at once, then taking updates off the queue
+    waits for one to finish.
+    """
+    slots = asyncio.Semaphore(conf["update_handlers"])
+    handling = set()
+
+    async def handle(update):
+        try:
+            await bot.process_new_updates([update])
+        except Exception:
+            traceback.print_exc()
+        finally:
+            slots.release()
+            queue.task_done()
+
+    try:
+        while True:
+            await slots.acquire()
+            update = await queue.get()
+            task = asyncio.create_task(handle(update))
+            handling.add(task)
+            task.add_done_callback(handling.discard)
+    finally:
+        for task in list(handling):
+            task.cancel()
+
+
+def create_app(bot, path, secret_token, queue, parse=Update.de_json):
+    """Build the aiohttp application that receives Telegram updates on path.
+
+    Updates are acknowledged as soon as they are parsed (with parse) and
+    queued; the handlers run in dispatch_updates(), not in the request.
+    """
+    async def receive_update(request):
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        try:
+            update = parse(await request.text())
+        except Exception as e:
+            print(f"Error parsing webhook update: {e}")
+            return web.Response(status=400)
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram redelivers updates that were not acknowledged with 200.
+            print("Webhook update queue is full, asking Telegram to retry later")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    return app
+
+
+async def serve(bot, url, secret_token=None, host="0.0.0.0", port=8080, router=None):
+    """Receive updates through a Telegram webhook at url instead of long polling.
+
+    With a router (see shards.Supervisor), the raw updates are handed to it
+    instead of being handled in this process.
+    """
+    if router is None:
+        queue = asyncio.Queue(maxsize=conf["webhook_queue_size"])
+        dispatcher = asyncio.create_task(dispatch_updates(bot, queue))
+        app = create_app(bot, urlparse(url).path or "/", secret_token, queue)
+    else:
+        dispatcher = None
+        app = create_app(bot, urlparse(url).path or "/", secret_token, router, parse=json.loads)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    await bot.set_webhook(url=url, secret_token=secret_token)
+    print(f"Webhook listening on {host}:{port}, registered at {url}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if dispatcher is not None:
+            dispatcher.cancel()
+        await runner.cleanup()